@@ -15,16 +15,34 @@ import os
 import re
 import csv
 import sys
+import gzip
+import stat
 import json
 import time
+import errno
 import codecs
+import signal
+import shutil
+import socket
+import hashlib
+import sqlite3
 import logging
+import argparse
+import mimetypes
+import contextlib
+import collections
+import threading
 import email.utils
 try:
     from urlparse import urlparse
 except ImportError:
     from urllib.parse import urlparse
-from collections import OrderedDict
+from string import Template
+from collections import OrderedDict, deque
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 import bottle
 
 ##### CONSTANTS ################################################################
@@ -32,6 +50,1404 @@ import bottle
 BASE_URL = 'http://10.0.0.1:8080/file/'  # Default base URL
 UPLOAD_DIR = 'uploaded'  # Default upload folder
 HIDE = r'\..*|autoinstall|media'  # Folders to hide
+PLACEHOLDER = re.compile(r'\${?(\w+)}?')  # $-based substitution name
+LOG_DIR = '.log'  # Folder holding the log segments
+LOG_SEGMENT_SIZE = 16 * 1024 * 1024  # Rotate log segment after this many bytes
+LOG_SEGMENT_AGE = 24 * 3600  # Rotate log segment after this many seconds
+LOG_INDEX = os.path.join(LOG_DIR, 'index.db')  # SQLite index of log entries
+LOG_PAGE_SIZE = 100  # Default number of log entries per page
+CHECKSUMS = '.checksums.json'  # File holding checksums of uploaded files
+CHUNK_SIZE = 1024 * 1024  # Bytes per read when saving uploaded files
+EVENTS_THREADS = 4  # Request threads per allowed event stream
+EVENTS_MIN = 2  # Event streams allowed regardless of the number of threads
+EVENTS_LIFETIME = 300  # Seconds before an event stream is closed by the server
+EVENTS_KEEPALIVE = 15  # Seconds between keepalive comments of event stream
+EVENTS_POLL = 1  # Seconds between checks for changes made by other workers
+TRANSFER_SIZE = 1024 * 1024  # Files of this many bytes or more are transfers
+TRANSFER_LIMIT = 32  # Maximum number of concurrent transfers
+TRANSFER_WAIT = 600  # Seconds a transfer waits in queue for a free slot
+TRANSFER_THREADS = 2  # Request threads per transfer allowed to wait in queue
+STATUSES = ('Finished', 'Failed', 'Upgrading', 'Renumbered')  # Counted statuses
+METRICS_DIR = '.metrics'  # Folder holding the metrics of the worker processes
+METRICS_SAVE = 5  # Seconds between saves of the metrics of a worker process
+
+##### CLASSES ##################################################################
+
+class Metrics(object):
+    """ Counters, gauges and histograms, rendered in the Prometheus text
+    exposition format. Worker processes share their metrics through files in
+    a folder, so every worker renders the sums of all workers """
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    HELP = {
+        'ztp_requests_total': ('counter', 'HTTP requests by route'),
+        'ztp_request_duration_seconds': ('histogram', 'Time to first byte of '
+                                         'HTTP responses by route'),
+        'ztp_file_bytes_total': ('counter', 'Bytes served from /file'),
+        'ztp_transfers_active': ('gauge', 'Transfers in progress'),
+        'ztp_transfers_waiting': ('gauge', 'Transfers waiting for a slot'),
+        'ztp_transfers_rejected_total': ('counter', 'Transfers refused for '
+                                         'lack of a free slot'),
+        'ztp_validate_seconds': ('histogram', 'Time spent validating data'),
+        'ztp_json_load_seconds': ('histogram', 'Time spent parsing JSON data'),
+        'ztp_json_dump_seconds': ('histogram', 'Time spent serializing JSON '
+                                  'data'),
+        'ztp_provisioning_total': ('counter', 'Log entries by status'),
+        'ztp_render_seconds': ('histogram', 'Time spent rendering '
+                               'configurations'),
+    }
+
+    def __init__(self):
+        """ Initializes empty metrics """
+        self.lock = threading.Lock()
+        self.counters = {}  # value by name and labels
+        self.histograms = {}  # bucket counts, sum and count by name and labels
+        self.gauges = {}  # function returning value by name
+        self.folder = None  # folder holding the metrics of all workers
+
+    def inc(self, name, value=1, **labels):
+        """ Increments counter with given labels """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ Adds value to histogram with given labels """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            entry = self.histograms.get(key)
+            if entry is None:
+                entry = self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    entry[0][i] += 1
+
+            entry[1] += value
+            entry[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """ Context manager that adds its duration to histogram """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def gauge(self, name, func):
+        """ Registers function that returns the value of a gauge """
+        self.gauges[name] = func
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        """ Returns label set in exposition format """
+        pairs = ['%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                        .replace('"', '\\"')
+                                        .replace('\n', '\\n'))
+                 for k, v in tuple(labels) + tuple(extra)]
+        return '{%s}' % ','.join(pairs) if pairs else ''
+
+    def snapshot(self):
+        """ Returns counters, histograms and gauge values as JSON data """
+        with self.lock:
+            return {'counters': [[name, labels, value] for (name, labels), value
+                                 in self.counters.items()],
+                    'histograms': [[name, labels] + entry for (name, labels),
+                                   entry in self.histograms.items()],
+                    'gauges': dict((name, func())
+                                   for name, func in self.gauges.items())}
+
+    def share(self, folder, interval):
+        """ Saves the metrics of this worker process to a file in folder every
+        interval seconds. Metrics inherited from the parent are cleared """
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+        self.folder = folder
+        self.save()
+
+        def run():
+            """ Saves metrics until the process exits """
+            while True:
+                time.sleep(interval)
+                self.save()
+
+        worker = threading.Thread(target=run)
+        worker.daemon = True
+        worker.start()
+
+    def save(self, snapshot=None):
+        """ Writes snapshot of this worker process to its file in folder """
+        try:
+            dump_json(snapshot or self.snapshot(),
+                      os.path.join(self.folder, '%d.json' % os.getpid()))
+        except (OSError, IOError) as e:
+            logging.error('Cannot save metrics: %s', e)
+
+    def collect(self):
+        """ Returns list of snapshots of this and the other worker processes.
+        Counters of workers that exited are kept, their gauges are left out """
+        snapshot = self.snapshot()
+        if self.folder is None:
+            return [snapshot]
+
+        self.save(snapshot)
+        snapshots = [snapshot]
+        for name in os.listdir(self.folder):
+            pid = name[:-len('.json')]
+            if not name.endswith('.json') or pid == str(os.getpid()):
+                continue
+
+            try:
+                with open(os.path.join(self.folder, name)) as infile:
+                    other = json.load(infile)
+            except (OSError, IOError, ValueError) as e:
+                logging.error('Cannot read metrics %s: %s', name, e)
+                continue
+
+            try:
+                os.kill(int(pid), 0)
+            except (OSError, ValueError):
+                other['gauges'] = {}
+            snapshots.append(other)
+
+        return snapshots
+
+    def render(self):
+        """ Returns all metrics in Prometheus text exposition format """
+        counters, histograms, gauges = {}, {}, {}
+        for snapshot in self.collect():
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                counters[key] = counters.get(key, 0) + value
+
+            for name, labels, buckets, total, count in snapshot['histograms']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                entry = histograms.setdefault(
+                    key, [[0] * len(self.BUCKETS), 0.0, 0])
+                entry[0] = [a + b for a, b in zip(entry[0], buckets)]
+                entry[1] += total
+                entry[2] += count
+
+            for name, value in snapshot['gauges'].items():
+                gauges[name] = gauges.get(name, 0) + value
+
+        samples = {}
+        for (name, labels), value in sorted(counters.items()):
+            samples.setdefault(name, []).append(
+                '%s%s %s' % (name, self._labels(labels), value))
+
+        for (name, labels), (buckets, total, count) in \
+                sorted(histograms.items()):
+            lines = samples.setdefault(name, [])
+            for bound, value in zip(self.BUCKETS, buckets):
+                lines.append('%s_bucket%s %d' % (
+                    name, self._labels(labels, [('le', bound)]), value))
+            lines.append('%s_bucket%s %d' % (
+                name, self._labels(labels, [('le', '+Inf')]), count))
+            lines.append('%s_sum%s %f' % (name, self._labels(labels), total))
+            lines.append('%s_count%s %d' % (name, self._labels(labels), count))
+
+        for name, value in gauges.items():
+            samples[name] = ['%s %s' % (name, value)]
+
+        result = []
+        for name in sorted(samples):
+            kind, text = self.HELP.get(name, ('untyped', name))
+            result.append('# HELP %s %s' % (name, text))
+            result.append('# TYPE %s %s' % (name, kind))
+            result.extend(samples[name])
+
+        return '\n'.join(result) + '\n'
+
+class FileLock(object):
+    """ Exclusive lock shared by the threads of this process and by other
+    worker processes, using an advisory lock on a lock file. Only the thread
+    lock is used on platforms without fcntl """
+    def __init__(self, filename):
+        """ Initializes object with lock file name """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.fd = None
+
+    def __enter__(self):
+        """ Acquires lock, waits for other threads and processes """
+        self.lock.acquire()
+        if fcntl:
+            try:
+                folder = os.path.dirname(self.filename)
+                if folder and not os.path.exists(folder):
+                    os.makedirs(folder)
+
+                self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            except (OSError, IOError):
+                if self.fd is not None:
+                    os.close(self.fd)
+                    self.fd = None
+                self.lock.release()
+                raise
+
+        return self
+
+    def __exit__(self, *exc_info):
+        """ Releases lock """
+        if self.fd is not None:
+            os.close(self.fd)  # releases advisory lock
+            self.fd = None
+
+        self.lock.release()
+
+class LogStore(object):
+    """ Append-only log of JSON objects, stored as newline delimited segment
+    files. The active segment is rotated by size and age and rotated segments
+    are compressed by a background thread. Worker processes append to the
+    same active segment """
+    def __init__(self, folder, max_size=LOG_SEGMENT_SIZE,
+                 max_age=LOG_SEGMENT_AGE):
+        """ Initializes object with folder and rotation limits """
+        self.folder = folder
+        self.max_size = max_size
+        self.max_age = max_age
+        self.lock = FileLock(os.path.join(folder, '.lock'))
+        self.zip_lock = threading.Lock()
+        self.active = None  # file object of the active segment
+        self.name = None  # file name of the active segment
+
+    def segments(self):
+        """ Returns sorted list of segment file names """
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            return []
+
+        plain = set(name for name in names if name.endswith('.ndjson'))
+        # skip compressed segment if plain segment is still present
+        return sorted(name for name in names if name in plain
+                      or name.endswith('.ndjson.gz') and name[:-3] not in plain)
+
+    def _create(self):
+        """ Opens a new active segment named after the creation time """
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+        stamp = int(time.time() * 1000)
+        names = self.segments()
+        last = int(names[-1].split('.')[0]) if names else 0
+        self.name = '%013d.ndjson' % max(stamp, last + 1)
+        self.active = open(os.path.join(self.folder, self.name), 'ab')
+
+    def _open(self):
+        """ Opens the newest segment if it is still plain, which another
+        worker process may have created, or else a new segment """
+        names = self.segments()
+        if names and names[-1].endswith('.ndjson'):
+            self.name = names[-1]
+            self.active = open(os.path.join(self.folder, self.name), 'ab')
+        else:
+            self._create()
+
+    def _rotate(self):
+        """ Closes the active segment and compresses it in the background """
+        self.active.close()
+        self.active = self.name = None
+        worker = threading.Thread(target=self.compress)
+        worker.daemon = True
+        worker.start()
+
+    def compress(self):
+        """ Compresses all plain segments except the active one """
+        with self.zip_lock:
+            for name in self.segments():
+                if not name.endswith('.ndjson') or name == self.name:
+                    continue
+
+                path = os.path.join(self.folder, name)
+                tempname = '%s.gz.%d.tmp' % (path, os.getpid())
+                try:
+                    with open(path, 'rb') as infile:
+                        with gzip.open(tempname, 'wb') as outfile:
+                            for chunk in iter(lambda: infile.read(65536), b''):
+                                outfile.write(chunk)
+
+                    rename(tempname, path + '.gz')
+                    os.remove(path)
+                except (OSError, IOError) as e:
+                    # another worker process may have compressed it already
+                    if os.path.exists(path):
+                        logging.error('Cannot compress %s: %s', path, e)
+                    if os.path.exists(tempname):
+                        os.remove(tempname)
+
+    def append(self, obj):
+        """ Appends JSON encoded object as a single line to active segment """
+        line = (json.dumps(obj) + '\n').encode('utf-8')
+        with self.lock:
+            # Another worker process may have rotated or removed the segment
+            if self.active and self.segments()[-1:] != [self.name]:
+                self.active.close()
+                self.active = self.name = None
+
+            if not self.active:
+                self._open()
+
+            size = os.fstat(self.active.fileno()).st_size
+            created = int(self.name.split('.')[0]) / 1000.0
+            if size and (size + len(line) > self.max_size
+                         or time.time() - created > self.max_age):
+                self._rotate()
+                self._create()
+
+            self.active.write(line)
+            self.active.flush()
+
+    def __iter__(self):
+        """ Yields JSON encoded objects as byte strings in order of arrival """
+        for name in self.segments():
+            path = os.path.join(self.folder, name)
+            try:
+                infile = open(path, 'rb')
+            except IOError:
+                # segment has been compressed in the meantime
+                try:
+                    infile = gzip.open(path + '.gz', 'rb')
+                except IOError:
+                    continue
+            else:
+                if name.endswith('.gz'):
+                    infile.close()
+                    infile = gzip.open(path, 'rb')
+
+            with infile:
+                for line in infile:
+                    # skip line that is still being written
+                    if line.endswith(b'\n') and line.strip():
+                        yield line.strip()
+
+    def clear(self):
+        """ Removes all segments """
+        with self.lock, self.zip_lock:
+            if self.active:
+                self.active.close()
+                self.active = self.name = None
+
+            for name in self.segments():
+                os.remove(os.path.join(self.folder, name))
+
+    def upgrade(self, legacy):
+        """ Imports legacy JSON log file and compresses leftover segments """
+        if os.path.exists(legacy):
+            with open(legacy) as infile:
+                for obj in json.load(infile):
+                    self.append(obj)
+
+            rename(legacy, legacy + '.old')
+            logging.info('Imported %s into %s', legacy, self.folder)
+
+        self.compress()
+
+class LogIndex(object):
+    """ SQLite database of log entries, indexed by serial number, status, IP
+    address, run and time of arrival, to query the log store page by page.
+    Delta log entries of a run are merged into a single entry """
+    FIELDS = ('serial', 'status', 'ip', 'run')
+
+    def __init__(self, filename):
+        """ Initializes object with database file name """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connect(self):
+        """ Opens database and creates schema once """
+        if self.conn is None:
+            folder = os.path.dirname(self.filename)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+
+            # transactions are started explicitly, see _transaction()
+            conn = sqlite3.connect(self.filename, check_same_thread=False,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS log (id INTEGER PRIMARY '
+                         'KEY AUTOINCREMENT, ts REAL, serial TEXT, status TEXT, '
+                         'ip TEXT, entry TEXT)')
+            # add columns of fields to database of a previous version
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(log)')]
+            for name in self.FIELDS:
+                if name not in columns:
+                    conn.execute('ALTER TABLE log ADD COLUMN %s TEXT' % name)
+            for name in ('ts',) + self.FIELDS:
+                conn.execute('CREATE INDEX IF NOT EXISTS log_%s ON log (%s, id)'
+                             % (name, name))
+            self.conn = conn
+
+        return self.conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """ Yields connection in a write transaction, which holds the write
+        lock of the database from its first read, so that another worker
+        process cannot merge into the same entry in the meantime """
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        conn.execute('COMMIT')
+
+    def _insert(self, conn, msg, ts):
+        """ Inserts log entry and returns its id """
+        values = [str(msg[k]) if msg.get(k) is not None else None
+                  for k in self.FIELDS]
+        cursor = conn.execute('INSERT INTO log (ts, %s, entry) VALUES (?, %s?)'
+                              % (', '.join(self.FIELDS), '?, ' * len(values)),
+                              [ts] + values + [json.dumps(msg)])
+        return cursor.lastrowid
+
+    @staticmethod
+    def merge(entry, msg):
+        """ Returns log entry updated with delta log entry. The logbuf of the
+        delta replaces the logbuf of the entry from its offset onwards, and so
+        do the CLI calls of the timing if the timing has an offset """
+        merged = dict(entry)
+        merged.update((k, v) for k, v in msg.items()
+                      if k not in ('logbuf', 'offset'))
+        logbuf = entry.get('logbuf', '')
+        offset = msg.get('offset', len(logbuf))
+        merged['logbuf'] = logbuf[:offset] + msg.get('logbuf', '')
+        timing, previous = msg.get('timing'), entry.get('timing')
+        if isinstance(timing, dict) and isinstance(timing.get('offset'), int) \
+                and isinstance(timing.get('calls'), list):
+            calls = previous.get('calls', []) \
+                if isinstance(previous, dict) else []
+            merged['timing'] = dict(phases=timing.get('phases', []),
+                                    calls=calls[:timing['offset']]
+                                    + timing['calls'])
+        return merged
+
+    def _add(self, conn, msg, ts):
+        """ Inserts log entry or merges delta log entry into the entry of its
+        run, which is inserted again to get a new id. Returns the id or None if
+        the delta log entry has been merged already """
+        if msg.get('run') is None:
+            return self._insert(conn, msg, ts)
+
+        row = conn.execute('SELECT id, entry FROM log WHERE run = ? ORDER BY '
+                           'id DESC LIMIT 1', [str(msg['run'])]).fetchone()
+        entry = json.loads(row[1]) if row else {}
+        if row and msg.get('seq', 0) <= entry.get('seq', 0):
+            return None
+
+        if row:
+            conn.execute('DELETE FROM log WHERE id = ?', [row[0]])
+
+        return self._insert(conn, self.merge(entry, msg), ts)
+
+    def add(self, msg, ts):
+        """ Adds log entry with time of arrival and returns its id or None if
+        it is a duplicate delta log entry """
+        with self.lock, self._transaction() as conn:
+            return self._add(conn, msg, ts)
+
+    def entries(self, size=1000):
+        """ Yields JSON encoded entries in order of id, a batch at a time """
+        after = 0
+        while True:
+            rows = self.query(after=after, limit=size)
+            for row_id, entry in rows:
+                yield entry.encode('utf-8')
+
+            if len(rows) < size:
+                return
+
+            after = rows[-1][0]
+
+    def query(self, after=0, before=None, since=None, until=None, limit=None,
+              **fields):
+        """ Returns list of tuples of id and JSON encoded entry. Entries are
+        sorted by id, descending if before is given """
+        where, args = ['id > ?'], [after]
+        if before is not None:
+            where, args = ['id < ?'], [before]
+        for name in self.FIELDS:
+            if fields.get(name) is not None:
+                where.append('%s = ?' % name)
+                args.append(fields[name])
+        if since is not None:
+            where.append('ts >= ?')
+            args.append(since)
+        if until is not None:
+            where.append('ts < ?')
+            args.append(until)
+        sql = 'SELECT id, entry FROM log WHERE %s ORDER BY id %s' % (
+            ' AND '.join(where), 'ASC' if before is None else 'DESC')
+        if limit:
+            sql += ' LIMIT %d' % limit
+        with self.lock:
+            return self._connect().execute(sql, args).fetchall()
+
+    def last_id(self):
+        """ Returns id of most recent log entry or 0 if there are none """
+        with self.lock:
+            row = self._connect().execute('SELECT MAX(id) FROM log').fetchone()
+            return row[0] or 0
+
+    def stamp(self):
+        """ Returns tuple of most recent id and number of log entries, which
+        changes with every added, merged or removed log entry """
+        with self.lock:
+            return tuple(self._connect().execute('SELECT MAX(id), COUNT(*) '
+                                                 'FROM log').fetchone())
+
+    def clear(self):
+        """ Removes all log entries """
+        with self.lock:
+            self._connect().execute('DELETE FROM log')
+
+    def close(self):
+        """ Closes database, which must not be shared with forked workers """
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def rebuild(self, store):
+        """ Fills empty database with the entries of the given log store """
+        with self.lock, self._transaction() as conn:
+            if conn.execute('SELECT 1 FROM log LIMIT 1').fetchone():
+                return
+
+            count = 0
+            for line in store:
+                try:
+                    msg = json.loads(line.decode('utf-8'))
+                    ts = time.mktime(time.strptime(msg.get('time', ''),
+                                                   '%x %X'))
+                except (ValueError, TypeError, AttributeError):
+                    ts = 0
+                if isinstance(msg, dict):
+                    self._add(conn, msg, ts)
+                    count += 1
+
+        if count:
+            logging.info('Indexed %d log entries', count)
+
+class TimingSummary(object):
+    """ Percentiles of the phase durations and CLI calls that script.py
+    reports, per phase, platform and version. The summary is computed again
+    when the log index changes """
+    PERCENTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1))
+    METRICS = ('seconds', 'cli_calls', 'cli_seconds')
+
+    def __init__(self):
+        """ Initializes empty summary """
+        self.lock = threading.Lock()
+        self.stamp = None  # stamp of the log index of the summary
+        self.summary = []
+
+    @staticmethod
+    def percentile(values, fraction):
+        """ Returns nearest-rank value at fraction of sorted values """
+        return values[min(int(len(values) * fraction), len(values) - 1)]
+
+    @staticmethod
+    def run(timing):
+        """ Returns list of phase name and list of seconds, CLI calls and CLI
+        seconds, in order of the phases, and totals of the run """
+        phases = collections.OrderedDict()
+        for name, seconds in timing.get('phases', []):
+            phases.setdefault(name, [0, 0, 0])[0] += float(seconds)
+        for name, command, seconds in timing.get('calls', []):
+            values = phases.setdefault(name, [0, 0, 0])
+            values[1] += 1
+            values[2] += float(seconds)
+
+        totals = [sum(values[i] for values in phases.values())
+                  for i in range(3)]
+        return list(phases.items()) + [('total', totals)]
+
+    def collect(self, entries):
+        """ Returns list of dicts with percentiles per phase, platform and
+        version of log entries holding timing """
+        groups = collections.OrderedDict()
+        for line in entries:
+            entry = json.loads(line.decode('utf-8'))
+            try:
+                phases = self.run(entry['timing'])
+            except (KeyError, TypeError, ValueError, AttributeError):
+                continue  # not reported or malformed
+
+            for name, values in phases:
+                key = (str(entry.get('platform', 'unknown')),
+                       str(entry.get('version', 'unknown')), name)
+                group = groups.setdefault(key, [[] for _ in self.METRICS])
+                for series, value in zip(group, values):
+                    series.append(value)
+
+        summary = []
+        for (platform, version, name), group in groups.items():
+            item = dict(platform=platform, version=version, phase=name,
+                        runs=len(group[0]))
+            for metric, series in zip(self.METRICS, group):
+                series.sort()
+                item[metric] = dict((label, round(self.percentile(series, f), 3))
+                                    for label, f in self.PERCENTILES)
+            summary.append(item)
+
+        # phases in order of first appearance, totals last
+        order = dict((key, i) for i, key in enumerate(groups))
+        summary.sort(key=lambda item: (item['platform'], item['version'],
+                                       item['phase'] == 'total',
+                                       order[(item['platform'], item['version'],
+                                              item['phase'])]))
+        return summary
+
+    def get(self, index):
+        """ Returns summary of the entries of the log index """
+        stamp = index.stamp()
+        with self.lock:
+            if stamp != self.stamp:
+                self.summary = self.collect(index.entries())
+                self.stamp = stamp
+
+            return self.summary
+
+class EventBus(object):
+    """ Wakes up event streams when log entries or the dataset change and
+    limits the number of event streams. Changes made by other worker processes
+    are noticed by polling if poll is set """
+    def __init__(self, limit=1, poll=None):
+        """ Initializes object with stream limit and poll interval """
+        self.limit = limit
+        self.poll = poll
+        self.cond = threading.Condition()
+        self.streams = 0
+        self.version = 0
+
+    def notify(self):
+        """ Wakes up all waiting event streams """
+        with self.cond:
+            self.version += 1
+            self.cond.notify_all()
+
+    def wait(self, version, timeout):
+        """ Waits for a notification if nothing changed since version and
+        returns the current version """
+        with self.cond:
+            if self.version == version:
+                self.cond.wait(min(timeout, self.poll or timeout))
+
+            return self.version
+
+    def open(self):
+        """ Returns True if an event stream may be opened """
+        with self.cond:
+            if self.streams >= self.limit:
+                return False
+
+            self.streams += 1
+            return True
+
+    def close(self):
+        """ Releases event stream """
+        with self.cond:
+            self.streams -= 1
+
+class Snapshot(object):
+    """ Validated dataset together with its serialized and compressed form.
+    Instances are shared between request threads and must not be modified """
+    def __init__(self, key, data, mtime):
+        """ Initializes object with file stats key, data and modified time """
+        self.key = key
+        self.data = data
+        self.mtime = mtime
+        with metrics.timer('ztp_json_dump_seconds'):
+            self.body = json.dumps(data).encode('utf-8')
+        self.gzip = gzip_bytes(self.body)
+        # strong entity tags differ per content coding
+        digest = hashlib.sha1(self.body).hexdigest()
+        self.etag = '"%s"' % digest
+        self.gzip_etag = '"%s-gzip"' % digest
+        # index stack objects by serial number
+        self.defaults = None
+        self.stacks = {}
+        # index object names and string values by normalized path
+        self.references = {}
+        for my in data:
+            if 'stack' in my:
+                self.stacks.update((v, my) for v in my['stack'].values())
+            else:
+                self.defaults = my
+
+            for name, value in my.items():
+                if hasattr(value, 'split'):
+                    self.references.setdefault(os.path.normpath(value),
+                                               []).append((name, value))
+
+    def used(self, path):
+        """ Returns list of tuples of object name and value that refer to the
+        given file path """
+        return self.references.get(os.path.normpath(path), [])
+
+    def lookup(self, serials):
+        """ Returns list with defaults and first stack matching any serial """
+        result = [self.defaults] if self.defaults is not None else []
+        stack = next((self.stacks[sn] for sn in serials if sn in self.stacks),
+                     None)
+        return result + [stack] if stack is not None else result
+
+class DataStore(object):
+    """ Single writer store of the dataset file. Readers get an immutable
+    snapshot without locking, which is reloaded when the file has changed.
+    Writers of all worker processes are serialized by a lock file """
+    def __init__(self, filename):
+        """ Initializes object with file name """
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.file_lock = FileLock(filename + '.lock')
+        self.snapshot = None
+
+    def stat(self):
+        """ Returns tuple of modified time, size and inode or None if absent """
+        try:
+            stats = os.stat(self.filename)
+        except OSError:
+            return None
+
+        return (stats.st_mtime, stats.st_size, stats.st_ino)
+
+    def get(self):
+        """ Returns snapshot of the dataset, reloads it if file has changed """
+        key = self.stat()
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.key == key:
+            return snapshot
+
+        with self.lock:
+            # another thread may have reloaded the file in the meantime
+            if self.snapshot is None or self.snapshot.key != key:
+                data = [OrderedDict(base_url=BASE_URL)]
+                if key is not None:
+                    with open(self.filename) as infile, \
+                            metrics.timer('ztp_json_load_seconds'):
+                        data = json.load(infile, object_pairs_hook=OrderedDict)
+
+                self.snapshot = Snapshot(key, validate(data), key and key[0])
+
+            return self.snapshot
+
+    def unchanged(self, since=None, etag=None):
+        """ Returns False if file was modified after since or if the entity
+        tag of the dataset does not match etag """
+        key = self.stat()
+        if since is not None and key is not None and int(key[0]) > since:
+            return False
+
+        if etag is not None:
+            try:
+                snapshot = self.get()
+                return etag.strip() in ('*', snapshot.etag, snapshot.gzip_etag)
+            except (ValueError, IOError):
+                return False
+
+        return True
+
+    def commit(self, data, since=None, etag=None):
+        """ Writes validated data to file and returns the new snapshot. Returns
+        None without writing if the file was changed, see unchanged() """
+        with self.lock, self.file_lock:
+            if not self.unchanged(since, etag):
+                return None
+
+            with metrics.timer('ztp_json_dump_seconds'):
+                dump_json(data, self.filename, indent=4)
+            key = self.stat()
+            self.snapshot = Snapshot(key, data, key[0])
+            return self.snapshot
+
+    def replace(self, tempname, since=None, etag=None):
+        """ Replaces file by validated temporary file and returns True. Returns
+        False without replacing if the file was changed, see unchanged() """
+        with self.lock, self.file_lock:
+            if not self.unchanged(since, etag):
+                return False
+
+            rename(tempname, self.filename)
+            return True
+
+class Validator(object):
+    """ Caches outcomes of validation checks between validation passes """
+    def __init__(self):
+        """ Initializes empty caches """
+        self.objects = {}  # objects that passed object checks by serials
+        self.templates = {}  # placeholder names by template string
+        self.files = {}  # stats and placeholder names by template file name
+        self.folders = {}  # stats and file names by folder name
+
+    def template_names(self, template):
+        """ Returns set of placeholder names found in template string """
+        names = self.templates.get(template)
+        if names is None:
+            if len(self.templates) > 1024:
+                self.templates = {}
+
+            names = frozenset(PLACEHOLDER.findall(template))
+            self.templates[template] = names
+
+        return names
+
+    def file_names(self, filename, stats):
+        """ Returns set of placeholder names found in template file """
+        if stats is None:
+            return frozenset()
+
+        cached = self.files.get(filename)
+        if cached is None or cached[0] != stats:
+            try:
+                with open(filename) as infile:
+                    names = frozenset(PLACEHOLDER.findall(infile.read()))
+            except (IOError, UnicodeDecodeError):
+                names = frozenset()
+
+            cached = self.files[filename] = (stats, names)
+
+        return cached[1]
+
+    def folder_names(self, folder, stats):
+        """ Returns set of file names found in folder """
+        if stats is None:
+            return frozenset()
+
+        cached = self.folders.get(folder)
+        if cached is None or cached[0] != stats:
+            try:
+                names = frozenset(os.listdir(folder))
+            except OSError:
+                names = frozenset()
+
+            cached = self.folders[folder] = (stats, names)
+
+        return cached[1]
+
+class Validation(object):
+    """ Single validation pass over a dataset, object by object. Objects that
+    passed before are not checked again and file system lookups are memoized """
+    def __init__(self, validator):
+        """ Initializes pass with cache object """
+        self.validator = validator
+        self.defaults = OrderedDict()
+        self.serials = set()
+        self.stats = {}
+        self.objects = {}
+
+    def stat(self, path):
+        """ Returns tuple of modified time and size or None if not found """
+        if path not in self.stats:
+            try:
+                stats = os.stat(path)
+                self.stats[path] = (stats.st_mtime, stats.st_size)
+            except (OSError, ValueError):
+                self.stats[path] = None
+
+        return self.stats[path]
+
+    def exists(self, path):
+        """ Returns True if path exists, based on cached folder contents """
+        folder, name = os.path.split(os.path.normpath(path))
+        folder = folder or '.'
+        if name in self.validator.folder_names(folder, self.stat(folder)):
+            return True
+
+        # confirm absence, for instance on case insensitive file systems
+        return os.path.exists(path)
+
+    def add(self, my):
+        """ Raises ValueError if object is invalid """
+        if not isinstance(my, OrderedDict):
+            raise ValueError('Expecting JSON array of objects')
+
+        # Only check objects that have changed since last pass
+        stack = my.get('stack')
+        key = tuple(stack.values()) if isinstance(stack, OrderedDict) else None
+        previous = self.validator.objects.get(key)
+        if previous is my or previous != my:
+            check_object(my)
+
+        self.objects[key] = my
+        defaults = self.defaults
+        if 'stack' in my:
+            # Check for duplicate values
+            if not self.serials.isdisjoint(my['stack'].values()):
+                raise ValueError("'stack' object values must be unique")
+
+            self.serials.update(my['stack'].values())
+            # Check if either is set
+            if (bool('version' in my or 'version' in defaults)
+                    != bool('install' in my or 'install' in defaults)):
+                raise ValueError("'version' and 'install' are both required")
+
+            # Check $-based substitutions
+            config = my.get('config', defaults.get('config', ''))
+            template = my.get('template', defaults.get('template', ''))
+            names = self.validator.template_names(template)
+            if config:
+                names = names | self.validator.file_names(config,
+                                                          self.stat(config))
+            subst = my.get('subst', defaults.get('subst', OrderedDict()))
+            for name in names.difference(subst.keys()):
+                raise ValueError("'%s' not found in all 'subst' objects" % name)
+
+        else:
+            if defaults:
+                raise ValueError("Only one object without 'stack' is allowed")
+            self.defaults = defaults = my
+
+        # Check local path existence only
+        for key in ('install', 'config'):
+            result = urlparse(my[key]) if key in my else None
+            if result and not result.scheme and result.path:
+                if 'base_url' not in my and 'base_url' not in defaults:
+                    raise ValueError("'base_url' required for relative paths")
+
+                if not self.exists(my[key]):
+                    raise ValueError("'%s' not found" % my[key])
+
+    def finish(self):
+        """ Remembers the objects of this pass for the next pass """
+        self.validator.objects = self.objects
+
+class FileIndex(object):
+    """ Cached listing of the files in the subfolders. A folder is only read
+    again if its modified time has changed or if it has been invalidated.
+    Writing to a file does not change the modified time of its folder, so the
+    files are stat'ed on every listing and only their items are cached """
+    def __init__(self, top='.'):
+        """ Initializes object with top folder """
+        self.top = top
+        self.lock = threading.Lock()
+        self.folders = {}  # tuple of stats, files and subfolders by folder
+        self.files = {}  # tuple of file item and modified time by path
+
+    def _scan(self, root, stats):
+        """ Returns tuple of stats, file paths and subfolders of folder """
+        files, dirs = [], []
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue  # broken link or removed in the meantime
+
+            if stat.S_ISDIR(info.st_mode):
+                # Don't visit hidden directories
+                if not re.match(HIDE, name):
+                    dirs.append((path, os.path.realpath(path)))
+            else:
+                files.append(path)
+
+        return stats, files, dirs
+
+    def _item(self, path):
+        """ Returns tuple of file item and modified time of file, the cached
+        item while size and modified time are unchanged, or None """
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None  # removed in the meantime
+
+        entry = self.files.get(path)
+        if entry and entry[1] == info.st_mtime \
+                and entry[0]['size'] == info.st_size:
+            return entry
+
+        mtime = time.strftime('%x %X', time.localtime(info.st_mtime))
+        return ({'file': path.replace('\\', '/'), 'time': mtime,
+                 'size': info.st_size}, info.st_mtime)
+
+    def items(self):
+        """ Returns list of tuples of file item and modified time """
+        result = []
+        with self.lock:
+            folders, files = {}, {}
+            seen = set()
+            pending = [(self.top, os.path.realpath(self.top))]
+            while pending:
+                root, real = pending.pop()
+                seen.add(real)
+                try:
+                    stats = os.stat(root).st_mtime
+                except OSError:
+                    continue
+
+                entry = self.folders.get(root)
+                if entry is None or entry[0] != stats:
+                    try:
+                        entry = self._scan(root, stats)
+                    except OSError:
+                        continue
+
+                folders[root] = entry
+                if root != self.top:
+                    for path in entry[1]:
+                        item = self._item(path)
+                        if item is not None:
+                            files[path] = item
+                            result.append(item)
+
+                # Don't visit same directories, depth first in listing order
+                pending.extend(reversed([(path, real) for path, real in entry[2]
+                                         if real not in seen]))
+
+            # Forget folders and files that are gone
+            self.folders = folders
+            self.files = files
+
+        return result
+
+    def invalidate(self, path):
+        """ Forces folder of given file path to be read again """
+        folder = os.path.join(self.top, os.path.normpath(os.path.dirname(path)))
+        with self.lock:
+            self.folders.pop(folder, None)
+
+class Transfer(object):
+    """ File object that is read from a given offset by the WSGI server. It
+    tracks the bytes sent and releases its transfer slot when closed """
+    def __init__(self, transfers, filename, client, start, length):
+        """ Opens file and initializes object with transfer details """
+        self.file = open(filename, 'rb')
+        self.file.seek(start)
+        self.transfers = transfers
+        self.filename = filename
+        self.client = client
+        self.start = start
+        self.length = length
+        self.begin = time.time()
+        self.end = None
+        self.sent = 0
+
+    def read(self, size=-1):
+        """ Reads at most size bytes from file """
+        return self.file.read(size)
+
+    def seek(self, offset, whence=0):
+        """ Changes file position """
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        """ Returns file position """
+        return self.file.tell()
+
+    def close(self):
+        """ Closes file and ends transfer """
+        if self.end is None:
+            # the server seeks past the bytes it has sent
+            self.sent = self.file.tell() - self.start
+            self.end = time.time()
+            self.file.close()
+            self.transfers.finish(self)
+
+    def stats(self):
+        """ Returns dict with transfer details and throughput """
+        try:
+            sent = self.sent if self.end else self.file.tell() - self.start
+        except ValueError:  # closed in the meantime
+            sent = self.sent
+        duration = (self.end or time.time()) - self.begin
+        return {'file': os.path.relpath(self.filename).replace('\\', '/'),
+                'client': self.client, 'offset': self.start,
+                'length': self.length, 'sent': sent,
+                'seconds': round(duration, 3),
+                'rate': int(sent / duration) if duration else 0}
+
+class Transfers(object):
+    """ Limits the number of concurrent transfers, queues transfers waiting
+    for a free slot and keeps transfer statistics. A waiting transfer holds a
+    request thread, so the queue is bounded and a transfer is only refused
+    when the queue is full or its wait timed out """
+    def __init__(self, limit=TRANSFER_LIMIT, queue=1, wait=TRANSFER_WAIT):
+        """ Initializes object with transfer limit, queue size and waiting
+        time """
+        self.limit = limit
+        self.queue = queue
+        self.wait = wait
+        self.cond = threading.Condition()
+        self.active = set()
+        self.waiting = 0
+        self.rejected = 0
+        self.completed = 0
+        self.sent = 0
+        self.recent = deque(maxlen=100)
+
+    def begin(self, filename, client, start, length):
+        """ Returns Transfer object when a slot is free or None if the queue
+        is full or on timeout """
+        deadline = time.time() + self.wait
+        with self.cond:
+            if len(self.active) >= self.limit and self.waiting >= self.queue:
+                return self._reject('queue is full')
+
+            self.waiting += 1
+            try:
+                while len(self.active) >= self.limit:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return self._reject('waited %d seconds' % self.wait)
+
+                    self.cond.wait(remaining)
+
+                transfer = Transfer(self, filename, client, start, length)
+                self.active.add(transfer)
+                return transfer
+            finally:
+                self.waiting -= 1
+
+    def _reject(self, reason):
+        """ Counts and logs a refused transfer and returns None """
+        self.rejected += 1
+        metrics.inc('ztp_transfers_rejected_total')
+        logging.error('Transfer refused, %s, %d active and %d waiting',
+                      reason, len(self.active), self.waiting)
+        return None
+
+    def finish(self, transfer):
+        """ Records statistics of ended transfer and frees its slot """
+        with self.cond:
+            self.active.discard(transfer)
+            self.completed += 1
+            self.sent += transfer.sent
+            metrics.inc('ztp_file_bytes_total', transfer.sent)
+            self.recent.append(transfer.stats())
+            self.cond.notify()
+
+    def stats(self):
+        """ Returns dict with active and recent transfers and totals """
+        with self.cond:
+            return {'limit': self.limit, 'queue': self.queue,
+                    'waiting': self.waiting, 'rejected': self.rejected,
+                    'completed': self.completed, 'sent': self.sent,
+                    'active': [transfer.stats() for transfer in self.active],
+                    'recent': list(self.recent)}
+
+class ChecksumIndex(object):
+    """ Persistent index of MD5 and SHA-256 digests of files, computed while
+    uploading. A digest is only valid while size and modified time match.
+    The index file is read again when another worker process has changed it """
+    def __init__(self, filename):
+        """ Initializes object with index file name """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.file_lock = FileLock(filename + '.lock')
+        self.compute_lock = threading.Lock()
+        self.entries = None
+        self.stats = None  # modified time, size and inode of loaded file
+        self.checked = 0  # time of last check for changes
+
+    @staticmethod
+    def key(path):
+        """ Returns normalized path relative to the script directory """
+        return os.path.normpath(path).replace('\\', '/')
+
+    def _stat(self):
+        """ Returns tuple of modified time, size and inode or None """
+        try:
+            stats = os.stat(self.filename)
+        except OSError:
+            return None
+
+        return (stats.st_mtime, stats.st_size, stats.st_ino)
+
+    def _load(self, force=False):
+        """ Loads index file once and again if it has changed, which is
+        checked at most once per second unless forced """
+        if self.entries is not None and not force \
+                and time.time() - self.checked < 1:
+            return
+
+        self.checked = time.time()
+        stats = self._stat()
+        if self.entries is None or stats != self.stats:
+            try:
+                with open(self.filename) as infile:
+                    self.entries = json.load(infile)
+            except (IOError, ValueError):
+                self.entries = {}
+            self.stats = stats
+
+    def _save(self):
+        """ Writes index to temporary file and replaces index file """
+        dump_json(self.entries, self.filename, indent=4, sort_keys=True)
+        self.stats = self._stat()
+
+    def add(self, path, md5, sha256):
+        """ Stores digests of file together with its current stats """
+        stats = os.stat(path)
+        with self.lock, self.file_lock:
+            self._load(force=True)
+            self.entries[self.key(path)] = {'size': stats.st_size,
+                                            'mtime': stats.st_mtime,
+                                            'md5': md5, 'sha256': sha256}
+            self._save()
+
+    def remove(self, path):
+        """ Removes digests of file """
+        with self.lock, self.file_lock:
+            self._load(force=True)
+            if self.entries.pop(self.key(path), None) is not None:
+                self._save()
+
+    def get(self, path, size, mtime):
+        """ Returns dict with digests or empty dict if unknown or outdated """
+        with self.lock:
+            self._load()
+            entry = self.entries.get(self.key(path))
+
+        if entry and entry['size'] == size and entry['mtime'] == mtime:
+            return {'md5': entry['md5'], 'sha256': entry['sha256']}
+
+        return {}
+
+    def compute(self, path):
+        """ Returns dict with digests of file, which are computed and stored
+        if unknown or outdated. One file is read at a time """
+        with self.compute_lock:
+            stats = os.stat(path)
+            digests = self.get(path, stats.st_size, stats.st_mtime)
+            if not digests:
+                md5, sha256 = hashlib.md5(), hashlib.sha256()
+                with open(path, 'rb') as infile:
+                    for chunk in iter(lambda: infile.read(CHUNK_SIZE), b''):
+                        md5.update(chunk)
+                        sha256.update(chunk)
+
+                self.add(path, md5.hexdigest(), sha256.hexdigest())
+                digests = {'md5': md5.hexdigest(), 'sha256': sha256.hexdigest()}
+
+            return digests
+
+class ConfigCache(object):
+    """ Renders the configuration of a stack like script.py does. Template
+    files are compiled once per modified time and size, rendered configurations
+    are cached per stack until the dataset or the template file changes """
+    def __init__(self):
+        """ Initializes empty caches """
+        self.lock = threading.Lock()
+        self.files = {}  # stats and compiled template by file name
+        self.templates = {}  # compiled template by template string
+        self.rendered = {}  # entity tag, stats and configuration by serials
+        self.etag = None  # entity tag of the dataset of the rendered configs
+
+    @staticmethod
+    def compile(text):
+        """ Returns list of literal strings and tuples of placeholder name
+        and source text, to substitute like Template.safe_substitute """
+        parts, pos = [], 0
+        for match in Template.pattern.finditer(text):
+            parts.append(text[pos:match.start()])
+            name = match.group('named') or match.group('braced')
+            if name is not None:
+                parts.append((name, match.group()))
+            elif match.group('escaped') is not None:
+                parts.append(Template.delimiter)
+            else:
+                parts.append(match.group())
+            pos = match.end()
+
+        parts.append(text[pos:])
+        return [part for part in parts if part]
+
+    @staticmethod
+    def substitute(parts, subst):
+        """ Returns compiled template with placeholders substituted """
+        return ''.join(part if not isinstance(part, tuple)
+                       else '%s' % subst[part[0]] if part[0] in subst
+                       else part[1] for part in parts)
+
+    def _file(self, filename, stats):
+        """ Returns tuple of template file without 'end' lines and its
+        compiled form """
+        cached = self.files.get(filename)
+        if cached is None or cached[0] != stats:
+            with io.open(filename, encoding='utf-8', errors='replace') as infile:
+                text = re.sub(r'^\s*end\s*$', '', infile.read(),
+                              flags=re.MULTILINE)
+
+            cached = self.files[filename] = (stats, text, self.compile(text))
+
+        return cached[1:]
+
+    def _template(self, template):
+        """ Returns compiled template string """
+        parts = self.templates.get(template)
+        if parts is None:
+            if len(self.templates) > 1024:
+                self.templates = {}
+
+            parts = self.templates[template] = self.compile(template)
+
+        return parts
+
+    def render(self, snapshot, serials):
+        """ Returns configuration of the stack matching any of the serials,
+        or of the defaults if there is none. The configuration file must be a
+        local path. Raises IOError if the configuration file is missing """
+        objects = snapshot.lookup(serials)
+        stack = objects[-1] if objects and 'stack' in objects[-1] else {}
+        defaults = objects[0] if objects and 'stack' not in objects[0] else {}
+        get = lambda key: stack.get(key, defaults.get(key))
+        config, template = get('config'), get('template')
+        if config and urlparse(config).scheme:
+            raise IOError("'%s' is not a local path" % config)
+
+        stats = None
+        if config:
+            info = os.stat(config)
+            stats = (info.st_mtime, info.st_size)
+
+        key = tuple(stack['stack'].values()) if stack else None
+        with self.lock:
+            if snapshot.etag != self.etag:
+                self.rendered = {}
+                self.etag = snapshot.etag
+
+            cached = self.rendered.get(key)
+            if cached is not None and cached[0] == stats:
+                return cached[1]
+
+            with metrics.timer('ztp_render_seconds'):
+                text, parts = self._file(config, stats) if config else ('', [])
+                if template:
+                    # same as appending the template to the file in script.py
+                    parts = parts + (['\n'] if text else []) \
+                        + self._template(template)
+                    text += '\n' + template if text else template
+
+                subst = get('subst')
+                conf = self.substitute(parts, subst) if subst else text
+
+            self.rendered[key] = (stats, conf)
+            return conf
+
+##### GLOBALS ##################################################################
+
+metrics = Metrics()
+logstore = LogStore(LOG_DIR)
+logindex = LogIndex(LOG_INDEX)
+events = EventBus()
+validator = Validator()
+fileindex = FileIndex()
+transfers = Transfers()
+metrics.gauge('ztp_transfers_active', lambda: len(transfers.active))
+metrics.gauge('ztp_transfers_waiting', lambda: transfers.waiting)
+checksums = ChecksumIndex(CHECKSUMS)
+datastore = DataStore('data.json')
+configs = ConfigCache()
+timings = TimingSummary()
 
 ##### FUNCTIONS ################################################################
 
@@ -42,6 +1458,70 @@ def log():
     path = bottle.request.path + '?' + qs if qs else bottle.request.path
     logging.info('%s - %s %s', ra, bottle.request.method, path)
 
+@bottle.hook('before_request')
+def start_timer():
+    """ Stores start time of request """
+    bottle.request.environ['ztp.start'] = time.time()
+
+@bottle.hook('after_request')
+def measure():
+    """ Counts request and adds its duration to histogram by route """
+    route = bottle.request.environ.get('bottle.route')
+    rule = route.rule if route else 'unmatched'
+    duration = time.time() - bottle.request.environ.get('ztp.start', time.time())
+    metrics.inc('ztp_requests_total', route=rule, method=bottle.request.method,
+                code=bottle.response.status_code)
+    metrics.observe('ztp_request_duration_seconds', duration, route=rule)
+
+def rename(src, dst):
+    """ Renames file, replacing destination if it exists """
+    try:
+        os.replace(src, dst)
+    except AttributeError:  # Python 2.7
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+def dump_json(data, filename, **kwargs):
+    """ Writes JSON data to temporary file and replaces file by it, so readers
+    never see a partially written file """
+    tempname = '%s.%d.%d.tmp' % (filename, os.getpid(),
+                                 threading.current_thread().ident)
+    try:
+        with open(tempname, 'w') as outfile:
+            json.dump(data, outfile, **kwargs)
+
+        rename(tempname, filename)
+    finally:
+        if os.path.exists(tempname):
+            os.remove(tempname)
+
+def json_array(items):
+    """ Yields JSON array from iterable of JSON encoded byte strings """
+    yield b'['
+    sep = b''
+    for item in items:
+        yield sep + item
+        sep = b', '
+    yield b']'
+
+def gzip_bytes(data):
+    """ Returns gzip compressed byte string """
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as outfile:
+        outfile.write(data)
+    return buf.getvalue()
+
+def etag_match(*etags):
+    """ Returns True if any entity tag matches If-None-Match request header """
+    header = bottle.request.get_header('If-None-Match')
+    if not header:
+        return False
+
+    tags = [tag.strip() for tag in header.split(',')]
+    # weak comparison as specified for If-None-Match
+    return '*' in tags or any(re.sub('^W/', '', tag) in etags for tag in tags)
+
 def error(msg, code=500):
     """ Sends HTTP status with error message string by raising HTTPResponse """
     raise bottle.HTTPResponse(body=json.dumps(str(msg)), status=code,
@@ -53,42 +1533,209 @@ def index(filename='index.html'):
     """ Frontend GUI app """
     return bottle.static_file(filename, root='.')
 
+def send_file(filename, stats):
+    """ Returns response that sends file or requested byte range of file as
+    a transfer, using the file wrapper of the WSGI server """
+    size = stats.st_size
+    modified = email.utils.formatdate(stats.st_mtime, usegmt=True)
+    etag = '"%x-%x"' % (int(stats.st_mtime * 1000), size)
+    headers = {'Content-Type': mimetypes.guess_type(filename)[0]
+                               or 'application/octet-stream',
+               'Last-Modified': modified, 'ETag': etag, 'Accept-Ranges': 'bytes'}
+    if etag_match(etag):
+        return bottle.HTTPResponse(status=304, **headers)
+
+    # Send single byte range, unless If-Range indicates a changed file
+    start, end, status = 0, size, 200
+    header = bottle.request.get_header('Range')
+    if_range = bottle.request.get_header('If-Range')
+    if header and (not if_range or if_range in (etag, modified)):
+        ranges = list(bottle.parse_range_header(header, size))
+        if not ranges:
+            headers['Content-Range'] = 'bytes */%d' % size
+            return bottle.HTTPResponse(status=416, **headers)
+
+        if len(ranges) == 1:
+            (start, end), status = ranges[0], 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
+
+    # Wait in queue for a free transfer slot
+    headers['Content-Length'] = str(end - start)
+    try:
+        transfer = transfers.begin(filename, bottle.request.remote_addr,
+                                   start, end - start)
+    except IOError as e:
+        error(e)
+
+    if transfer is None:
+        raise bottle.HTTPResponse(body=json.dumps('Too many transfers'),
+                                  status=503,
+                                  headers={'Content-type': 'application/json',
+                                           'Retry-After': str(TRANSFER_WAIT)})
+
+    return bottle.HTTPResponse(transfer, status=status, **headers)
+
 @bottle.get('/file/<filepath:path>')
 def get_file(filepath):
-    """ Serves files and subfolders """
-    return bottle.static_file(filepath, root='.')
+    """ Serves files and subfolders, large files as limited transfers """
+    root = os.path.join(os.path.abspath('.'), '')
+    filename = os.path.abspath(os.path.join(root, filepath.strip('/\\')))
+    try:
+        stats = os.stat(filename)
+    except OSError:
+        stats = None
+
+    # Let Bottle handle small files, HEAD requests and errors
+    if (bottle.request.method == 'HEAD' or not filename.startswith(root)
+            or stats is None or not stat.S_ISREG(stats.st_mode)
+            or stats.st_size < TRANSFER_SIZE):
+        resp = bottle.static_file(filepath, root='.')
+        if bottle.request.method == 'GET' and resp.status_code in (200, 206):
+            metrics.inc('ztp_file_bytes_total',
+                        int(resp.headers.get('Content-Length', 0)))
+        return resp
+
+    return send_file(filename, stats)
+
+@bottle.get('/metrics')
+def get_metrics():
+    """ Sends metrics in Prometheus text exposition format """
+    bottle.response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return metrics.render()
+
+@bottle.get('/transfers')
+def get_transfers():
+    """ Sends active and recent file transfers and throughput statistics """
+    # Prepare response header
+    bottle.response.content_type = 'application/json'
+    bottle.response.expires = 0
+    bottle.response.set_header('Pragma', 'no-cache')
+    bottle.response.set_header('Cache-Control',
+                               'no-cache, no-store, must-revalidate')
+    return json.dumps(transfers.stats())
+
+def remove_file(filepath, snapshot):
+    """ Removes file unless it is referred to by the dataset. Raises ValueError
+    if the file is in use or OSError if it cannot be removed """
+    filepath = os.path.normpath(filepath)
+    root = os.path.join(os.path.abspath('.'), '')
+    if not os.path.abspath(filepath).startswith(root):
+        raise ValueError("Cannot delete. '%s' is outside of the app folder"
+                         % filepath)
+
+    if snapshot is not None:
+        for obj, name in snapshot.used(filepath)[:1]:
+            raise ValueError("Cannot delete. '%s' is used by '%s' object"
+                             % (name, obj))
+
+    os.remove(filepath)
+    fileindex.invalidate(filepath)
+    checksums.remove(filepath)
+
+def current_snapshot():
+    """ Returns snapshot of the dataset or None if it cannot be loaded """
+    try:
+        return datastore.get()
+    except (ValueError, IOError):
+        return None
 
 @bottle.delete('/file/<filepath:path>')
 def delete_file(filepath):
     """ Removes specified file """
-    filepath = os.path.normpath(filepath)
     try:
-        with open('data.json') as infile:
-            data = validate(json.load(infile, object_pairs_hook=OrderedDict))
+        remove_file(filepath, current_snapshot())
+    except (ValueError, OSError) as e:
+        error(e)
 
-        # Check string object values for filepath
-        for obj, name in (item for my in data for item in my.items()):
-            if hasattr(name, 'split') and filepath == os.path.normpath(name):
-                error("Cannot delete. '%s' is used by '%s' object" % (name, obj))
-    except (ValueError, IOError):
-        pass
+@bottle.delete('/file')
+def delete_files():
+    """ Removes files given as JSON array of paths and sends the removed
+    paths and the error messages per path as JSON text """
+    try:
+        paths = json.loads(bottle.request.body.getvalue())
+        if not isinstance(paths, list):
+            raise ValueError('Expecting JSON array of paths')
+    except ValueError as e:
+        error(e, 400)
+
+    snapshot = current_snapshot()
+    removed, errors = [], OrderedDict()
+    for path in paths:
+        try:
+            remove_file(path, snapshot)
+            removed.append(path)
+        except (ValueError, OSError, TypeError, AttributeError) as e:
+            errors[str(path)] = str(e)
+
+    bottle.response.content_type = 'application/json'
+    return json.dumps(OrderedDict([('removed', removed), ('errors', errors)]))
+
+def save_upload(infile, path, length=None):
+    """ Copies stream to temporary file in chunks, while computing checksums,
+    and renames it to path when complete """
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    tempname = '%s.%d.%d.tmp' % (path, os.getpid(),
+                                 threading.current_thread().ident)
+    try:
+        with open(tempname, 'wb') as outfile:
+            remaining = length
+            while remaining is None or remaining > 0:
+                size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE,
+                                                               remaining)
+                chunk = infile.read(size)
+                if not chunk:
+                    break
+
+                md5.update(chunk)
+                sha256.update(chunk)
+                outfile.write(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+
+        if remaining:
+            raise IOError('Upload of %s is incomplete' % path)
+
+        rename(tempname, path)
+    finally:
+        if os.path.exists(tempname):
+            os.remove(tempname)
+
+    fileindex.invalidate(path)
+    checksums.add(path, md5.hexdigest(), sha256.hexdigest())
+
+@bottle.get('/md5/<filepath:path>')
+def get_md5(filepath):
+    """ Sends MD5 digest of file as plain text, for verification of a copy
+    on the switch """
+    root = os.path.join(os.path.abspath('.'), '')
+    filename = os.path.abspath(os.path.join(root, filepath.strip('/\\')))
+    if not filename.startswith(root) or not os.path.isfile(filename):
+        error('File does not exist.', 404)
 
     try:
-        os.remove(filepath)
-    except OSError as e:
+        digests = checksums.compute(os.path.relpath(filename, root))
+    except (OSError, IOError) as e:
         error(e)
 
+    bottle.response.content_type = 'text/plain'
+    return digests['md5']
+
 @bottle.put('/file/<filepath:path>')
 def put_file(filepath):
-    """ Handles file upload """
+    """ Handles file upload by streaming the request body to file """
     folder, filename = os.path.split(filepath)
     folder = folder or UPLOAD_DIR
-    upload = bottle.FileUpload(bottle.request.body, None, filename=filename)
+    # Sanitize file name
+    filename = bottle.FileUpload(None, None, filename=filename).filename
+    length = bottle.request.content_length
     try:
-        if folder and not os.path.exists(folder):
-            os.makedirs(folder)
-
-        upload.save(os.path.join(folder, upload.filename), overwrite=True)
+        save_upload(bottle.request.environ['wsgi.input'],
+                    os.path.join(folder, filename),
+                    length if length >= 0 else None)
     except (OSError, IOError) as e:
         error(e)
 
@@ -97,31 +1744,56 @@ def post_file():
     """ Handles form data for file uploading """
     folder = bottle.request.forms.get('folder') or UPLOAD_DIR
     upload = bottle.request.files.get('upload')
-    try:
-        if folder and not os.path.exists(folder):
-            os.makedirs(folder)
+    if upload is None:
+        error('No file uploaded', 400)
 
-        upload.save(os.path.join(folder, upload.filename), overwrite=True)
+    try:
+        upload.file.seek(0)
+        save_upload(upload.file, os.path.join(folder, upload.filename))
     except (OSError, IOError) as e:
         error(e)
 
+def list_items(items, snapshot):
+    """ Yields JSON encoded file items, including checksums if known and the
+    number of objects in the dataset that refer to the file. Size, time and
+    checksums are those of the file now, not of the cached listing """
+    for item, mtime in items:
+        try:
+            info = os.stat(item['file'])
+        except OSError:
+            continue  # removed in the meantime
+
+        item = dict(item, size=info.st_size, time=time.strftime(
+            '%x %X', time.localtime(info.st_mtime)))
+        item.update(checksums.get(item['file'], info.st_size, info.st_mtime))
+        item['used'] = len(snapshot.used(item['file'])) if snapshot else 0
+        yield json.dumps(item).encode('utf-8')
+
 @bottle.route('/list')
 def get_list():
-    """ Compiles a list of files and sends it to the web server """
-    result = []
-    seen = set()
-    for root, dirs, files in os.walk('.', followlinks=True):
-        seen.add(os.path.realpath(root))
-        # Don't visit hidden and same directories
-        dirs[:] = [name for name in dirs if not re.match(HIDE, name)
-                   and os.path.realpath(os.path.join(root, name)) not in seen]
-        if root != '.':
-            for name in files:
-                filename = os.path.join(root, name)
-                stats = os.stat(filename)
-                mtime = time.strftime('%x %X', time.localtime(stats.st_mtime))
-                result.append({'file': filename.replace('\\', '/'),
-                               'time': mtime, 'size': stats.st_size})
+    """ Streams a filtered, sorted and paginated list of files to web server """
+    query = bottle.request.query
+    try:
+        offset = int(query.get('offset') or 0)
+        limit = int(query.get('limit') or 0)
+    except ValueError:
+        error('Offset and limit must be numbers', 400)
+
+    # Filter by path relative to the script directory
+    items = fileindex.items()
+    prefix = re.sub(r'^\./', '', query.get('prefix', ''))
+    if prefix:
+        items = [item for item in items if item[0]['file'][2:].startswith(prefix)]
+
+    # Sort by given key, files are in directory listing order by default
+    reverse = query.get('order') == 'desc'
+    if query.get('sort') == 'time':
+        items.sort(key=lambda item: item[1], reverse=reverse)
+    elif query.get('sort') in ('file', 'size'):
+        key = query.get('sort')
+        items.sort(key=lambda item: item[0][key], reverse=reverse)
+    elif reverse:
+        items.reverse()
 
     # Prepare response header
     bottle.response.content_type = 'application/json'
@@ -129,151 +1801,299 @@ def get_list():
     bottle.response.set_header('Pragma', 'no-cache')
     bottle.response.set_header('Cache-Control',
                                'no-cache, no-store, must-revalidate')
-    return json.dumps(result)
+    bottle.response.set_header('X-Total-Count', str(len(items)))
+    page = items[offset:offset + limit] if limit else items[offset:]
+    return json_array(list_items(page, current_snapshot()))
 
 @bottle.get('/data')
 def get_data():
-    """ Parses JSON file into an OrderedDict and sends it to the web server """
+    """ Sends cached and validated JSON data to the web server """
+    # Load and validate JSON data if file has changed
+    try:
+        snapshot = datastore.get()
+    except (ValueError, IOError) as e:
+        error(e)
+
     # Prepare response header
     bottle.response.content_type = 'application/json'
     bottle.response.expires = 0
     bottle.response.set_header('Pragma', 'no-cache')
-    bottle.response.set_header('Cache-Control',
-                               'no-cache, no-store, must-revalidate')
-    # Load, validate and send JSON data
-    data = [OrderedDict(base_url=BASE_URL)]
+    bottle.response.set_header('Cache-Control', 'no-cache')
+    bottle.response.set_header('Vary', 'Accept-Encoding')
+    compress = 'gzip' in bottle.request.get_header('Accept-Encoding', '')
+    bottle.response.set_header('ETag', snapshot.gzip_etag if compress
+                               else snapshot.etag)
+    if snapshot.mtime is not None:
+        # Include last modified date in response header
+        value = email.utils.formatdate(snapshot.mtime, usegmt=True)
+        bottle.response.set_header('Last-Modified', value)
+
+    # Client has an up-to-date copy in either content coding
+    if etag_match(snapshot.etag, snapshot.gzip_etag):
+        bottle.response.status = 304
+        return b''
+
+    # Send precompressed JSON data if client accepts it
+    if compress:
+        bottle.response.set_header('Content-Encoding', 'gzip')
+        return snapshot.gzip
+
+    return snapshot.body
+
+@bottle.get('/data/<serials>')
+def get_data_serial(serials):
+    """ Sends defaults and stack matching any of comma separated serials """
     try:
-        if os.path.exists('data.json'):
-            # Include last modified date in response header
-            value = email.utils.formatdate(os.path.getmtime('data.json'),
-                                           usegmt=True)
-            bottle.response.set_header('Last-Modified', value)
-            with open('data.json') as infile:
-                data = json.load(infile, object_pairs_hook=OrderedDict)
-
-        return json.dumps(validate(data))
+        snapshot = datastore.get()
     except (ValueError, IOError) as e:
         error(e)
 
+    # Prepare response header
+    bottle.response.content_type = 'application/json'
+    bottle.response.expires = 0
+    bottle.response.set_header('Pragma', 'no-cache')
+    bottle.response.set_header('Cache-Control',
+                               'no-cache, no-store, must-revalidate')
+    return json.dumps(snapshot.lookup(serials.split(',')))
+
+def preconditions():
+    """ Returns tuple of If-Unmodified-Since and If-Match request headers """
+    since = bottle.parse_date(bottle.request.get_header('If-Unmodified-Since'))
+    return since, bottle.request.get_header('If-Match')
+
 @bottle.post('/data')
 def post_data():
     """ Parses posted JSON data into an OrderedDict and writes to file """
-    # Make sure the data has not changed in the meantime
-    ius = bottle.parse_date(bottle.request.get_header('If-Unmodified-Since'))
-    if ius and int(os.path.getmtime('data.json')) > ius:
-        error('Discarding changes because server data was modified', 412)
-
     if bottle.request.content_type == 'application/json':
         # Load, validate and write JSON data
         try:
-            data = validate(json.loads(bottle.request.body.getvalue(),
-                                       object_pairs_hook=OrderedDict))
-            with open('data.json', 'w') as outfile:
-                json.dump(data, outfile, indent=4)
+            with metrics.timer('ztp_json_load_seconds'):
+                data = json.loads(bottle.request.body.getvalue(),
+                                  object_pairs_hook=OrderedDict)
+            validate(data)
+            # Make sure the data has not changed in the meantime
+            snapshot = datastore.commit(data, *preconditions())
+            if snapshot is None:
+                error('Discarding changes because server data was modified',
+                      412)
+
+            bottle.response.set_header('ETag', snapshot.etag)
+            events.notify()
         except (ValueError, IOError) as e:
             error(e)
 
+@bottle.get('/config/<serials>')
+def get_config(serials):
+    """ Sends configuration rendered for stack matching any of comma
+    separated serials """
+    try:
+        conf = configs.render(datastore.get(), serials.split(','))
+    except (ValueError, IOError, OSError) as e:
+        error(e, 404)
+
+    bottle.response.content_type = 'text/plain; charset=utf-8'
+    bottle.response.set_header('Cache-Control', 'no-cache')
+    return conf
+
+@bottle.post('/config')
+def post_config():
+    """ Renders the configurations of all stacks in advance and sends the
+    number of configurations and the errors per stack as JSON text """
+    try:
+        snapshot = datastore.get()
+    except (ValueError, IOError) as e:
+        error(e)
+
+    start = time.time()
+    count, errors = 0, OrderedDict()
+    for my in snapshot.data:
+        if 'stack' in my:
+            try:
+                configs.render(snapshot, list(my['stack'].values()))
+                count += 1
+            except (IOError, OSError) as e:
+                errors[','.join(my['stack'].values())] = str(e)
+
+    bottle.response.content_type = 'application/json'
+    return json.dumps(OrderedDict([('rendered', count),
+                                   ('seconds', round(time.time() - start, 3)),
+                                   ('errors', errors)]))
+
+def flatten(dct):
+    """ Returns OrderedDict with nested object names joined by a slash """
+    flat = OrderedDict()
+    for k in dct:
+        if isinstance(dct[k], OrderedDict):
+            for kk in dct[k]:
+                flat[str(k) + '/' + str(kk)] = dct[k][kk]
+        else:
+            flat[k] = dct[k]
+    return flat
+
+def unflatten(dct):
+    """ Returns original cubic data structure of flattened OrderedDict """
+    cubic = OrderedDict()
+    for k in dct:
+        # Split keys
+        kk = k.split('/')
+        if dct[k] and len(kk) == 2:
+            if kk[0] in cubic:
+                cubic[kk[0]].update(OrderedDict([(kk[1], dct[k])]))
+            else:
+                cubic[kk[0]] = OrderedDict([(kk[1], dct[k])])
+        else:
+            if dct[k] == "True":
+                cubic[k] = True
+            elif dct[k]:
+                cubic[k] = dct[k]
+    return cubic
+
+def csv_export(data, bufsize=65536):
+    """ Yields flattened data as CSV text in chunks of about bufsize """
+    # Find column names in a pass over the object names only
+    columns = OrderedDict()
+    for dct in data:
+        for k in dct:
+            if isinstance(dct[k], OrderedDict):
+                columns.update((str(k) + '/' + str(kk), None) for kk in dct[k])
+            else:
+                columns[k] = None
+
+    # Write CSV rows to buffer and send buffer when full
+    csvbuf = io.BytesIO() if sys.version_info[0] < 3 else io.StringIO()
+    writer = csv.DictWriter(csvbuf, fieldnames=list(columns), delimiter=';')
+    writer.writeheader()
+    for dct in data:
+        writer.writerow(flatten(dct))
+        if csvbuf.tell() >= bufsize:
+            yield csvbuf.getvalue()
+            csvbuf.seek(0)
+            csvbuf.truncate()
+
+    yield csvbuf.getvalue()
+
 @bottle.get('/csv')
 def get_csv():
-    """ Converts JSON file to CSV and sends it to web server """
-    with open('data.json') as infile:
-        data = validate(json.load(infile, object_pairs_hook=OrderedDict))
-        # Flatten JSON data
-        flat_data = []
-        for dct in data:
-            flat = OrderedDict()
-            for k in dct:
-                if isinstance(dct[k], OrderedDict):
-                    for kk in dct[k]:
-                        flat[str(k) + '/' + str(kk)] = dct[k][kk]
-                else:
-                    flat[k] = dct[k]
-            flat_data.append(flat)
-
-        # Find column names
-        columns = [k for row in flat_data for k in row]
-        columns = list(OrderedDict.fromkeys(columns).keys())
-        # Write CSV to buffer
-        csvbuf = io.BytesIO() if sys.version_info[0] < 3 else io.StringIO()
-        writer = csv.DictWriter(csvbuf, fieldnames=columns, delimiter=';')
-        writer.writeheader()
-        writer.writerows(flat_data)
-        # Prepare response header
-        bottle.response.content_type = 'text/csv'
-        bottle.response.expires = 0
-        bottle.response.set_header('Pragma', 'no-cache')
-        bottle.response.set_header('Cache-Control',
-                                   'no-cache, no-store, must-revalidate')
-        bottle.response.set_header('Content-Disposition',
-                                   'attachment; filename="export.csv"')
-        return csvbuf.getvalue()
+    """ Converts cached JSON data to CSV and streams it to web server """
+    try:
+        snapshot = datastore.get()
+    except (ValueError, IOError) as e:
+        error(e)
+
+    # Prepare response header
+    bottle.response.content_type = 'text/csv'
+    bottle.response.expires = 0
+    bottle.response.set_header('Pragma', 'no-cache')
+    bottle.response.set_header('Cache-Control',
+                               'no-cache, no-store, must-revalidate')
+    bottle.response.set_header('Content-Disposition',
+                               'attachment; filename="export.csv"')
+    return csv_export(snapshot.data)
 
 @bottle.post('/csv')
 def post_csv():
-    """ Converts uploaded CSV to JSON data and writes to file """
+    """ Converts uploaded CSV to JSON data row by row and writes to file """
     upload = bottle.request.files.get('upload')
+    if upload is None:
+        error('No CSV file uploaded', 400)
+
     reader = csv.reader(codecs.iterdecode(upload.file, 'utf-8'), delimiter=';')
-    headers = next(reader)
-    data = []
-    for row in reader:
-        dct = OrderedDict(zip(headers, row))
-        # Construct original cubic data structure
-        cubic = OrderedDict()
-        for k in dct:
-            # Split keys
-            kk = k.split('/')
-            if dct[k] and len(kk) == 2:
-                if kk[0] in cubic:
-                    cubic[kk[0]].update(OrderedDict([(kk[1], dct[k])]))
-                else:
-                    cubic[kk[0]] = OrderedDict([(kk[1], dct[k])])
-            else:
-                if dct[k] == "True":
-                    cubic[k] = True
-                elif dct[k]:
-                    cubic[k] = dct[k]
-        data.append(cubic)
+    headers = next(reader, None)
+    if not headers:
+        error('CSV file is empty', 400)
 
-    # Validate and write JSON data
+    # Validate each row and write it to a temporary file
+    validation = Validation(validator)
+    errors = []
+    tempname = '%s.%d.%d.tmp' % (datastore.filename, os.getpid(),
+                                 threading.current_thread().ident)
     try:
-        validate(data)
-        with open('data.json', 'w') as outfile:
-            json.dump(data, outfile, indent=4)
-    except (ValueError, IOError) as e:
+        with open(tempname, 'w') as outfile:
+            sep = '[\n'
+            for row in reader:
+                cubic = unflatten(OrderedDict(zip(headers, row)))
+                try:
+                    validation.add(cubic)
+                except ValueError as e:
+                    errors.append('Line %d: %s' % (reader.line_num, e))
+                    if len(errors) == 10:
+                        break
+                    continue
+
+                # Same layout as json.dump with indent of 4
+                text = json.dumps(cubic, indent=4)
+                outfile.write(sep + '    ' + text.replace('\n', '\n    '))
+                sep = ',\n'
+
+            outfile.write('\n]' if sep != '[\n' else '[]')
+
+        if errors:
+            raise ValueError('\n'.join(errors))
+
+        # Replace data file only if all rows are valid and data is unchanged
+        if not datastore.replace(tempname, *preconditions()):
+            error('Discarding import because server data was modified', 412)
+
+        validation.finish()
+        events.notify()
+    except (ValueError, IOError, csv.Error) as e:
         error(e)
+    finally:
+        if os.path.exists(tempname):
+            os.remove(tempname)
 
-@bottle.get('/log')
-def log_get():
-    """ Parses JSON log file and sends it to the web server """
-    logbuf = []
+def query_log(query):
+    """ Returns dict with a page of log entries matching query parameters,
+    the cursor of the next page, or None if there are no more entries, and
+    the cursor of the last entry of the page, or None if it is empty """
     try:
-        if os.path.exists('log.json'):
-            with open('log.json') as infile:
-                logbuf = json.load(infile)
-    except (ValueError, IOError) as e:
-        error(e)
+        limit = min(int(query.get('limit') or LOG_PAGE_SIZE), 1000)
+        cursor = query.get('cursor')
+        descending = query.get('order') == 'desc'
+        args = {'since': float(query['since']) if query.get('since') else None,
+                'until': float(query['until']) if query.get('until') else None}
+        if cursor:
+            args['before' if descending else 'after'] = int(cursor)
+        elif descending:
+            args['before'] = sys.maxsize
+    except ValueError:
+        error('Invalid limit, cursor, since or until parameter', 400)
+
+    if limit < 1:
+        error('Invalid limit parameter', 400)
+
+    args.update((name, query.get(name) or None) for name in LogIndex.FIELDS)
+    rows = logindex.query(limit=limit + 1, **args)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return {'entries': [json.loads(entry) for _, entry in rows],
+            'next': str(rows[-1][0]) if more else None,
+            'last': str(rows[-1][0]) if rows else None}
 
+@bottle.get('/log')
+def log_get():
+    """ Sends JSON log entries from the log index, all of them or a page of
+    entries if query parameters are given """
     # Prepare response header
     bottle.response.content_type = 'application/json'
     bottle.response.expires = 0
     bottle.response.set_header('Pragma', 'no-cache')
     bottle.response.set_header('Cache-Control',
                                'no-cache, no-store, must-revalidate')
-    # Send log buffer
-    return json.dumps(logbuf)
+    if bottle.request.query_string:
+        try:
+            return json.dumps(query_log(bottle.request.query))
+        except sqlite3.Error as e:
+            error(e)
+
+    # Send log entries with merged delta log entries, a batch at a time
+    return json_array(logindex.entries())
 
 @bottle.post('/log')
 @bottle.put('/log')
 def log_put():
-    """ Appends JSON log entries to file """
-    logbuf = []
-    try:
-        if os.path.exists('log.json'):
-            with open('log.json') as infile:
-                logbuf = json.load(infile)
-    except (ValueError, IOError) as e:
-        error(e)
-
+    """ Appends JSON log entry to log store and log index. A delta log entry,
+    with run, seq and offset, is merged into the log entry of its run """
     try:
         msg = json.loads(bottle.request.body.getvalue())
         if not isinstance(msg, dict):
@@ -281,112 +2101,289 @@ def log_put():
 
         msg['ip'] = bottle.request.remote_addr
         msg['time'] = time.strftime('%x %X')
-        logbuf.append(msg)
-        # Write log buffer to file
-        with open('log.json', 'w') as outfile:
-            json.dump(logbuf, outfile, indent=4)
-    except (ValueError, IOError) as e:
+        if logindex.add(msg, time.time()) is None:
+            return  # delta log entry has been received before
+
+        logstore.append(msg)
+        events.notify()
+        if msg.get('status'):
+            # Unauthenticated clients must not create unlimited label values
+            status = msg['status'] if msg['status'] in STATUSES else 'other'
+            metrics.inc('ztp_provisioning_total', status=status)
+    except (ValueError, IOError, sqlite3.Error) as e:
+        error(e)
+
+@bottle.get('/log/summary')
+def log_summary():
+    """ Sends JSON list with percentiles of the phase durations and CLI calls
+    reported by script.py, per phase, platform and version """
+    try:
+        summary = timings.get(logindex)
+    except (ValueError, sqlite3.Error) as e:
         error(e)
 
+    bottle.response.content_type = 'application/json'
+    return json.dumps(summary)
+
 @bottle.delete('/log')
 def log_delete():
-    """ Empties JSON log file """
-    # Just write empty list to file
+    """ Empties log store and log index """
     try:
-        with open('log.json', 'w') as outfile:
-            json.dump([], outfile)
-    except (ValueError, IOError) as e:
+        logstore.clear()
+        logindex.clear()
+    except (OSError, IOError, sqlite3.Error) as e:
         error(e)
 
-def validate(data):
-    """ Raises ValueError if data is invalid """
-    if not isinstance(data, list):
-        raise ValueError('Expecting JSON array of objects')
+def event_stream(cursor):
+    """ Yields server-sent events for log entries after the cursor and for
+    dataset changes, until the lifetime of the stream has passed """
+    try:
+        yield 'retry: 5000\n\n'
+        deadline = time.time() + EVENTS_LIFETIME
+        keepalive = time.time() + EVENTS_KEEPALIVE
+        version = etag = None
+        while time.time() < deadline:
+            version = events.wait(version, EVENTS_KEEPALIVE)
+            # Send log entries added by any thread or process
+            rows = logindex.query(after=cursor, limit=100)
+            for row_id, entry in rows:
+                cursor = row_id
+                yield 'id: %d\nevent: log\ndata: %s\n\n' % (row_id, entry)
 
-    defaults = OrderedDict()
-    stack_values = []
-    for my in data:
-        if not isinstance(my, OrderedDict):
-            raise ValueError('Expecting JSON array of objects')
+            if len(rows) == 100:
+                version = None  # don't wait, more entries are pending
 
-        if 'stack' in my:
-            if not isinstance(my['stack'], OrderedDict):
-                raise ValueError("'stack' must be JSON object")
+            # Send entity tag and modified date if the dataset has changed
+            try:
+                snapshot = datastore.get()
+            except (ValueError, IOError):
+                snapshot = None
+            if snapshot is not None and snapshot.etag != etag:
+                if etag is not None:
+                    modified = snapshot.mtime and email.utils.formatdate(
+                        snapshot.mtime, usegmt=True)
+                    yield 'event: data\ndata: %s\n\n' % json.dumps(
+                        {'etag': snapshot.etag, 'modified': modified})
+                etag = snapshot.etag
 
-            # Check for keys that are not a natural number
-            if any(True for k in my['stack'] if not k.isdigit()):
-                raise ValueError("'stack' object name must be a number")
+            if time.time() >= keepalive:
+                keepalive = time.time() + EVENTS_KEEPALIVE
+                yield ': keepalive\n\n'
+    except sqlite3.Error as e:
+        logging.error('Event stream stopped: %s', e)
+    finally:
+        events.close()
 
-            # Check for blank values
-            if any(True for v in my['stack'].values() if not v or v.isspace()):
-                raise ValueError("Empty 'stack' object value not allowed")
+@bottle.get('/events')
+def get_events():
+    """ Streams new log entries and dataset changes as server-sent events.
+    Streams resume from the Last-Event-ID header or the cursor parameter """
+    cursor = (bottle.request.get_header('Last-Event-ID')
+              or bottle.request.query.get('cursor'))
+    try:
+        cursor = int(cursor) if cursor else logindex.last_id()
+    except ValueError:
+        error('Invalid cursor', 400)
+    except sqlite3.Error as e:
+        error(e)
 
-            # Check for duplicate values
-            if (len(set(my['stack'].values())) != len(my['stack'].values())
-                    or any(v in stack_values for v in my['stack'].values())):
-                raise ValueError("'stack' object values must be unique")
+    if not events.open():
+        error('Too many event streams', 503)
 
-            stack_values.extend(my['stack'].values())
-            # Check if either is set
-            if (bool('version' in my or 'version' in defaults)
-                    != bool('install' in my or 'install' in defaults)):
-                raise ValueError("'version' and 'install' are both required")
+    # Prepare response header
+    bottle.response.content_type = 'text/event-stream'
+    bottle.response.set_header('Cache-Control', 'no-cache')
+    bottle.response.set_header('X-Accel-Buffering', 'no')
+    return event_stream(cursor)
 
-            # Check $-based substitutions
-            config = my.get('config', defaults.get('config', ''))
-            template = my.get('template', defaults.get('template', ''))
-            try:
-                with open(config) as infile:
-                    template += infile.read()
-            except:
-                pass
-            subst = my.get('subst', defaults.get('subst', OrderedDict()))
-            names = set(re.findall(r'\${?(\w+)}?', template))
-            for name in names - set(subst.keys()):
-                raise ValueError("'%s' not found in all 'subst' objects" % name)
+def check_object(my):
+    """ Raises ValueError if object is invalid regardless of other objects """
+    if 'stack' in my:
+        if not isinstance(my['stack'], OrderedDict):
+            raise ValueError("'stack' must be JSON object")
 
-        else:
-            if defaults:
-                raise ValueError("Only one object without 'stack' is allowed")
-            defaults = my
+        # Check for keys that are not a natural number
+        if any(True for k in my['stack'] if not k.isdigit()):
+            raise ValueError("'stack' object name must be a number")
 
-        if 'subst' in my:
-            if not isinstance(my['subst'], OrderedDict):
-                raise ValueError("'subst' must be JSON object")
+        # Check for blank values
+        if any(True for v in my['stack'].values() if not v or v.isspace()):
+            raise ValueError("Empty 'stack' object value not allowed")
 
-            if any(True for k in my['subst'] if k.startswith('$')):
-                raise ValueError("'subst' object name should not start with $")
+        # Check for duplicate values within stack
+        if len(set(my['stack'].values())) != len(my['stack'].values()):
+            raise ValueError("'stack' object values must be unique")
 
-        if 'base_url' in my:
-            result = urlparse(my['base_url'])
-            if not all((result.scheme, result.netloc)):
-                raise ValueError("'base_url' is not valid")
+    if 'subst' in my:
+        if not isinstance(my['subst'], OrderedDict):
+            raise ValueError("'subst' must be JSON object")
 
-            if not result.path.endswith('/'):
-                raise ValueError("'base_url' should end with /")
+        if any(True for k in my['subst'] if k.startswith('$')):
+            raise ValueError("'subst' object name should not start with $")
 
-        # Check local path existence only
-        for key in ('install', 'config'):
-            result = urlparse(my.get(key, ''))
-            if not result.scheme and result.path:
-                if 'base_url' not in my and 'base_url' not in defaults:
-                    raise ValueError("'base_url' required for relative paths")
+    if 'base_url' in my:
+        result = urlparse(my['base_url'])
+        if not all((result.scheme, result.netloc)):
+            raise ValueError("'base_url' is not valid")
 
-                if not os.path.exists(my[key]):
-                    raise ValueError("'%s' not found" % my[key])
+        if not result.path.endswith('/'):
+            raise ValueError("'base_url' should end with /")
+
+    # Check for empty dicts
+    if not all(v for v in my.values() if isinstance(v, OrderedDict)):
+        raise ValueError('Empty JSON object not allowed')
 
-        # Check for empty dicts
-        if not all(v for v in my.values() if isinstance(v, OrderedDict)):
-            raise ValueError('Empty JSON object not allowed')
+    # Check for blank keys
+    if any(True for k in my if not k or k.isspace()):
+        raise ValueError('Empty JSON object name not allowed')
+
+def validate(data):
+    """ Raises ValueError if data is invalid """
+    if not isinstance(data, list):
+        raise ValueError('Expecting JSON array of objects')
 
-        # Check for blank keys
-        if any(True for k in my if not k or k.isspace()):
-            raise ValueError('Empty JSON object name not allowed')
+    with metrics.timer('ztp_validate_seconds'):
+        validation = Validation(validator)
+        for my in data:
+            validation.add(my)
 
+        validation.finish()
     return data
 
+def parse_args():
+    """ Returns command line arguments, which default to environment
+    variables """
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default=env('ZTP_BIND_HOST', '0.0.0.0'),
+                        help='address to listen on (ZTP_BIND_HOST)')
+    parser.add_argument('--port', type=int,
+                        default=int(env('ZTP_BIND_PORT', 8080)),
+                        help='port to listen on (ZTP_BIND_PORT)')
+    parser.add_argument('--threads', type=int,
+                        default=int(env('ZTP_THREADS', 32)),
+                        help='request threads per worker (ZTP_THREADS)')
+    parser.add_argument('--connection-limit', type=int,
+                        default=int(env('ZTP_CONNECTION_LIMIT', 100)),
+                        help='open connections per worker before new '
+                        'connections wait (ZTP_CONNECTION_LIMIT)')
+    parser.add_argument('--channel-timeout', type=int,
+                        default=int(env('ZTP_CHANNEL_TIMEOUT', 120)),
+                        help='seconds before an inactive connection is closed '
+                        '(ZTP_CHANNEL_TIMEOUT)')
+    parser.add_argument('--send-buffer', type=int,
+                        default=int(env('ZTP_SEND_BUFFER', 0)),
+                        help='socket send buffer size in bytes, 0 for the '
+                        'system default (ZTP_SEND_BUFFER)')
+    parser.add_argument('--outbuf-high-watermark', type=int,
+                        default=int(env('ZTP_OUTBUF_HIGH_WATERMARK',
+                                        16 * 1024 * 1024)),
+                        help='bytes buffered per connection before the request '
+                        'thread waits (ZTP_OUTBUF_HIGH_WATERMARK)')
+    parser.add_argument('--workers', type=int,
+                        default=int(env('ZTP_WORKERS', 1)),
+                        help='worker processes sharing the port using '
+                        'SO_REUSEPORT (ZTP_WORKERS)')
+    args = parser.parse_args()
+    if args.threads < 2 * EVENTS_MIN:
+        parser.error('--threads must be at least %d' % (2 * EVENTS_MIN))
+    if args.workers > 1 and not (hasattr(os, 'fork') and fcntl
+                                 and hasattr(socket, 'SO_REUSEPORT')):
+        parser.error('--workers requires fork() and SO_REUSEPORT')
+
+    return args
+
+def listen(args):
+    """ Returns listening socket, which shares its port with other workers """
+    family = socket.AF_INET6 if ':' in args.host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if args.workers > 1:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if args.send_buffer:
+        # inherited by the accepted connections
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, args.send_buffer)
+    sock.bind((args.host, args.port))
+    return sock
+
+def serve(args):
+    """ Runs Waitress server with the given tuning options. Event streams
+    and transfers waiting for a slot occupy a request thread each, so they
+    are limited to a share of the threads to keep threads free for the
+    switches """
+    import waitress
+    events.limit = max(EVENTS_MIN, args.threads // EVENTS_THREADS)
+    transfers.queue = max(1, (args.threads - events.limit) // TRANSFER_THREADS)
+    waitress.serve(bottle.default_app(), sockets=[listen(args)],
+                   threads=args.threads,
+                   connection_limit=args.connection_limit,
+                   channel_timeout=args.channel_timeout,
+                   outbuf_high_watermark=args.outbuf_high_watermark)
+
+def run_workers(args):
+    """ Forks worker processes that each run a Waitress server on their own
+    socket bound to the same port and restarts workers that exit """
+    # The database connection must not be inherited by forked workers
+    logindex.close()
+    events.poll = EVENTS_POLL
+    # Metrics of a previous run must not be added up
+    if os.path.exists(METRICS_DIR):
+        shutil.rmtree(METRICS_DIR)
+    os.makedirs(METRICS_DIR)
+
+    def start():
+        """ Forks a worker and returns its process id """
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                metrics.share(METRICS_DIR, METRICS_SAVE)
+                serve(args)
+            finally:
+                os._exit(1)
+
+        return pid
+
+    def stop(signum, frame):
+        """ Terminates all workers """
+        stopping.append(signum)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    stopping = []
+    workers = set(start() for _ in range(args.workers))
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logging.info('Started %d workers on %s:%d', len(workers), args.host,
+                 args.port)
+    while workers:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                break
+            continue  # interrupted by signal
+
+        workers.discard(pid)
+        if not stopping:
+            logging.error('Worker %d exited with status %d, restarting', pid,
+                          status)
+            time.sleep(1)
+            workers.add(start())
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    # import log file of previous versions
+    logstore.upgrade('log.json')
+    logindex.rebuild(logstore)
 
-    bottle.run(host='0.0.0.0', port=8080, server='waitress')
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        serve(args)
@@ -0,0 +1,360 @@
+""" IOS XE CLI Simulator
+This package stands in for the cli module of the guestshell, so script.py can
+run off the device. It emulates the outputs of the show commands script.py
+parses, more, copy, dir and verify for the device state of a profile. Remote
+files are transferred over HTTP, local file systems (flash:, bootflash: and
+flash-N:) are folders of a root directory. Other commands are recorded as
+events and return no output.
+
+Configuration lines following a sub-mode command are its sub-commands, when
+they are indented or are interface sub-commands, like IOS applies a flat
+configuration. Interface sub-commands in global configuration mode fail.
+
+Every call sleeps for the latency of the longest matching command prefix in
+LATENCY, the empty prefix is the default, and is appended to calls.
+
+Usage:
+    import cli
+    cli.load(cli.PROFILES['stack'], root)
+    cli.LATENCY.update({'': 0.1, 'copy': 1.0})
+"""
+
+import os
+import re
+import time
+import base64
+import hashlib
+try:
+    from urllib2 import urlopen, Request, HTTPError, URLError
+except ImportError:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError, URLError
+
+from .profiles import PROFILES
+
+# configuration commands that enter a sub-mode
+PARENT = re.compile(r'^(interface|router|line|vlan|ip access-list|'
+                    r'(class|policy|route)-map|event manager applet)\b')
+# sub-commands of interfaces
+SUBCOMMAND = re.compile(r'^(no )?(description|switchport|shutdown|ip address|'
+                        r'channel-group|spanning-tree portfast|speed|duplex|'
+                        r'power inline)\b')
+
+LATENCY = {}  # seconds of latency by command prefix
+calls = []  # tuples of function, command and seconds of every call
+device = None  # device state of the loaded profile
+
+class CLISyntaxError(Exception):
+    """ Raised for commands with invalid syntax """
+
+class CLIConfigurationError(Exception):
+    """ Raised for failed configuration commands """
+
+class Device():
+    """ State of a simulated device """
+    def __init__(self, profile, root):
+        """ Initializes device with profile and creates its flash files in the
+        root directory """
+        self.profile = profile
+        self.root = root
+        self.switches = [dict(switch) for switch in profile['switches']]
+        self.running = []  # lists of top-level command and sub-commands
+        self.events = []  # commands that change state outside the simulator
+        self.configure(profile.get('running', []))
+        for name in profile['flash']:
+            with open(os.path.join(root, name), 'ab'):
+                pass
+
+    @property
+    def config(self):
+        """ Lines of the running configuration """
+        return [line for command, subcommands in self.running
+                for line in [command] + [' ' + sub for sub in subcommands]]
+
+    def stanza(self, command):
+        """ Returns top-level command and sub-commands, adds it if missing """
+        for stanza in self.running:
+            if stanza[0] == command:
+                return stanza
+
+        self.running.append([command, []])
+        return self.running[-1]
+
+    def configure(self, lines):
+        """ Applies configuration lines, raises CLIConfigurationError with the
+        lines that are invalid in global configuration mode """
+        failed = []
+        stanza = None
+        for line in lines:
+            command = line.strip()
+            if not command or command.startswith('!') or command == 'end':
+                continue
+            if command == 'exit':
+                stanza = None
+            elif PARENT.match(command):
+                stanza = self.stanza(command)
+            elif stanza is not None and (line[0].isspace()
+                                         or SUBCOMMAND.match(command)):
+                if command not in stanza[1]:
+                    stanza[1].append(command)
+            elif SUBCOMMAND.match(command):
+                failed.append(command)
+            else:
+                stanza = None
+                self.stanza(command)
+
+        if failed:
+            raise CLIConfigurationError('%% Invalid input detected: %s'
+                                        % ', '.join(failed))
+
+    def local(self, url):
+        """ Returns path of a file on a local file system or None for a remote
+        URL. A URL without file system is relative to flash """
+        match = re.match(r'^(?:bootflash|flash|flash-\d+):/?(.*)$', url)
+        if match:
+            return os.path.join(self.root, match.group(1))
+
+        if ':' not in url:
+            return os.path.join(self.root, url)
+
+        return None
+
+    def request(self, url, method='GET', data=None):
+        """ Returns response body of HTTP request """
+        req = Request(url, data)
+        req.get_method = lambda: method
+        resp = urlopen(req, timeout=60)
+        try:
+            return resp.read()
+        finally:
+            resp.close()
+
+    def read(self, url):
+        """ Returns contents of local or remote file, raises IOError """
+        path = self.local(url)
+        if path is None:
+            return self.request(url)
+
+        with open(path, 'rb') as infile:
+            return infile.read()
+
+    def show_inventory(self):
+        """ Output of show inventory | format """
+        entries = []
+        if self.profile['chassis']:
+            entries.append(('"Chassis"', self.profile['chassis']))
+        for switch in self.switches:
+            entries.append(('"Switch %d"' % switch['number'], switch['serial']))
+
+        return ('<?xml version="1.0" encoding="UTF-8"?><ShowInventory>%s'
+                '</ShowInventory>' % ''.join(
+                    '<InventoryEntry><ChassisName>%s</ChassisName>'
+                    '<Description>"Cisco Catalyst 9000"</Description>'
+                    '<PID>%s</PID><SN>%s</SN></InventoryEntry>'
+                    % (name, self.profile['platform'], serial)
+                    for name, serial in entries))
+
+    def show_version(self):
+        """ Output of show version """
+        return ('Cisco IOS XE Software, Version %s\n'
+                'Cisco IOS Software [Amsterdam], Catalyst L3 Switch Software\n'
+                'ROM: IOS-XE ROMMON\n'
+                'System image file is "%s"\n'
+                % (self.profile['version'], self.profile['image']))
+
+    def show_switch(self):
+        """ Output of show switch """
+        lines = ['Switch/Stack Mac Address : 00a0.c900.0001 - Local Mac Address',
+                 'Mac persistency wait time: Indefinite',
+                 '                                             H/W   Current',
+                 'Switch#   Role    Mac Address     Priority Version  State',
+                 '-' * 61]
+        for index, switch in enumerate(self.switches):
+            lines.append('%s%-8d %-8s 00a0.c900.%04d     %-6d V02     %s'
+                         % ('*' if index == 0 else ' ', switch['number'],
+                            'Active' if index == 0 else 'Member',
+                            switch['number'], switch['priority'],
+                            switch['state']))
+        return '\n'.join(lines) + '\n'
+
+    def show_running_config(self):
+        """ Output of show running-config with the configured lines """
+        text = '\n'.join(self.config)
+        return ('Building configuration...\n\nCurrent configuration : %d bytes'
+                '\n!\n%s\n!\nend\n' % (len(text), text))
+
+    def show_file_information(self, url):
+        """ Output of show file information, the type is derived from the
+        file name """
+        try:
+            path = self.local(url)
+            if path is None:
+                self.request(url, 'HEAD')
+            elif not os.path.exists(path):
+                raise IOError('No such file or directory')
+        except (IOError, URLError) as e:
+            return '%%Error opening %s (%s)' % (url, error_reason(e))
+
+        if url.endswith('.bin'):
+            return '%s:\n  type is image (IFS) [IOSXE_PACKAGE]\n' % url
+
+        return '%s:\n  type is ascii text\n' % url
+
+    def more(self, url):
+        """ Output of more, which is a hex dump for files read over the
+        network """
+        try:
+            data = self.read(url)
+        except (IOError, URLError) as e:
+            return '%%Error opening %s (%s)' % (url, error_reason(e))
+
+        lines = ['Loading %s ' % url]
+        for offset in range(0, len(data), 16):
+            chunk = base64.b16encode(data[offset:offset + 16]).decode('ascii')
+            chunk = chunk.ljust(32, 'X')
+            words = ' '.join(chunk[i:i + 8] for i in range(0, 32, 8))
+            text = ''.join(chr(c) if 32 <= c < 127 else '.'
+                           for c in bytearray(data[offset:offset + 16]))
+            lines.append('%08X: %s    %s' % (offset, words, text))
+        return '\n'.join(lines)
+
+    def copy(self, source, target):
+        """ Output of copy, a remote target is uploaded with HTTP PUT """
+        if source == 'running-config':
+            return 'Building configuration...\n[OK]'
+
+        try:
+            data = self.read(source)
+            path = self.local(target)
+            if path is None:
+                self.request(target, 'PUT', data)
+            else:
+                with open(path, 'wb') as outfile:
+                    outfile.write(data)
+        except (IOError, URLError) as e:
+            return '%%Error opening %s (%s)' % (source, error_reason(e))
+
+        return ('Accessing %s...\n[OK - %d bytes]\n\n%d bytes copied'
+                % (source, len(data), len(data)))
+
+    def dir(self, url):
+        """ Output of dir for a single file """
+        path = self.local(url)
+        if path is None or not os.path.isfile(path):
+            return '%%Error opening %s (No such file or directory)' % url
+
+        return 'Directory of %s\n\n    1  -rw-  %d  %s\n' \
+            % (url, os.path.getsize(path), os.path.basename(path))
+
+    def verify(self, url, digest):
+        """ Output of verify /md5 with expected digest """
+        try:
+            computed = hashlib.md5(self.read(url)).hexdigest()
+        except (IOError, URLError) as e:
+            return '%%Error opening %s (%s)' % (url, error_reason(e))
+
+        if computed == digest.lower():
+            return 'Verified (%s) = %s' % (url, computed)
+
+        return ('%%Error verifying %s\nComputed signature   = %s\n'
+                'Submitted signature  = %s' % (url, computed, digest))
+
+    def switch(self, number, key, value):
+        """ Output of switch renumber and switch priority commands """
+        for switch in self.switches:
+            if switch['number'] == number:
+                # renumbering takes effect after reload
+                if key == 'priority':
+                    switch['priority'] = value
+                self.events.append('switch %d %s %d' % (number, key, value))
+                return ''
+
+        raise CLISyntaxError('Switch %d not present' % number)
+
+    def execute(self, command):
+        """ Returns output of a single command """
+        if command == 'show inventory | format':
+            return self.show_inventory()
+        if command == 'show version':
+            return self.show_version()
+        if command == 'show switch':
+            return self.show_switch()
+        if command == 'show running-config':
+            return self.show_running_config()
+
+        match = re.match(r'^show file information (\S+)$', command)
+        if match:
+            return self.show_file_information(match.group(1))
+        match = re.match(r'^more (\S+)$', command)
+        if match:
+            return self.more(match.group(1))
+        match = re.match(r'^copy (\S+) (\S+)$', command)
+        if match:
+            return self.copy(match.group(1), match.group(2))
+        match = re.match(r'^dir (\S+)$', command)
+        if match:
+            return self.dir(match.group(1))
+        match = re.match(r'^verify /md5 (\S+) (\S+)$', command)
+        if match:
+            return self.verify(match.group(1), match.group(2))
+        match = re.match(r'^switch (\d+) (renumber|priority) (\d+)$', command)
+        if match:
+            return self.switch(int(match.group(1)), match.group(2),
+                               int(match.group(3)))
+
+        self.events.append(command)
+        return ''
+
+def error_reason(e):
+    """ Returns reason of a failed file access like IOS reports it """
+    if isinstance(e, HTTPError) and e.code == 404:
+        return 'No such file or directory'
+
+    return str(getattr(e, 'reason', None) or getattr(e, 'strerror', None) or e)
+
+def load(profile, root):
+    """ Loads device profile with flash in root directory and clears calls """
+    global device
+    device = Device(profile, root)
+    del calls[:]
+
+def call(function, command):
+    """ Sleeps for the latency of the command and records the call """
+    keys = [key for key in LATENCY if command.startswith(key)]
+    seconds = LATENCY[max(keys, key=len)] if keys else 0
+    if seconds:
+        time.sleep(seconds)
+    calls.append((function, command, seconds))
+
+def execute(command):
+    """ Executes a single exec command and returns its output """
+    command = command.strip()
+    call('execute', command)
+    return device.execute(command)
+
+def configure(configuration):
+    """ Applies configuration lines, a string or a list """
+    if not isinstance(configuration, (list, tuple)):
+        configuration = configuration.splitlines()
+    call('configure', 'configure')
+    device.configure(configuration)
+    return []
+
+def cli(command):
+    """ Executes commands separated by semicolons and returns their output """
+    command = command.strip()
+    call('cli', command)
+    return '\n'.join(device.execute(part.strip())
+                     for part in command.split(';') if part.strip())
+
+def executep(command):
+    """ Executes exec command and prints its output """
+    print(execute(command))
+
+def configurep(configuration):
+    """ Applies configuration lines and prints the results """
+    print(configure(configuration))
+
+def clip(command):
+    """ Executes commands and prints their output """
+    print(cli(command))
@@ -0,0 +1,105 @@
+""" Device profiles of the simulator
+Every profile describes the hardware and software state of a simulated device
+and the dataset entry it is provisioned with:
+- 'chassis' : serial number of a non-stackable device, or None
+- 'platform': product ID of the chassis or of the switches
+- 'switches': list of dicts with number, serial, priority and state of the
+              members of a stack, the first member is active
+- 'version' : running IOS XE version
+- 'image'   : file the device booted from, a .bin file means bundle mode
+- 'flash'   : names of files on flash
+- 'running' : optional list of lines of the running configuration
+- 'files'   : optional dict with contents by path of files served by app.py
+- 'data'    : dataset entry of the device, merged with the defaults of the
+              benchmark dataset
+"""
+
+FLAT = """hostname $hostname
+interface GigabitEthernet1/0/1
+description uplink
+switchport mode trunk
+interface GigabitEthernet1/0/2
+description $hostname access
+switchport mode access
+ip domain name lab
+"""
+
+PROFILES = {
+    # non-stackable device running the target version, applies configuration
+    'chassis': {
+        'chassis': 'FXS2222Q0A1',
+        'platform': 'C9500-24Y4C',
+        'switches': [],
+        'version': '17.03.01',
+        'image': 'bootflash:packages.conf',
+        'flash': ['packages.conf'],
+        'data': {'stack': {'1': 'FXS2222Q0A1'},
+                 'subst': {'hostname': 'core1'},
+                 'cli': 'show license summary'},
+    },
+    # stack numbered as in the dataset, applies configuration
+    'stack': {
+        'chassis': None,
+        'platform': 'C9300-48P',
+        'switches': [
+            {'number': 1, 'serial': 'FOC2222X0A1', 'priority': 15,
+             'state': 'Ready'},
+            {'number': 2, 'serial': 'FOC2222X0A2', 'priority': 14,
+             'state': 'Ready'},
+        ],
+        'version': '17.03.01',
+        'image': 'flash:packages.conf',
+        'flash': ['packages.conf'],
+        'data': {'stack': {'1': 'FOC2222X0A1', '2': 'FOC2222X0A2'},
+                 'subst': {'hostname': 'access1'},
+                 'cli': 'show switch'},
+    },
+    # stack with a member in version mismatch state, runs autoupgrade
+    'v-mismatch': {
+        'chassis': None,
+        'platform': 'C9300-48P',
+        'switches': [
+            {'number': 1, 'serial': 'FOC2222X0B1', 'priority': 15,
+             'state': 'Ready'},
+            {'number': 2, 'serial': 'FOC2222X0B2', 'priority': 1,
+             'state': 'V-Mismatch'},
+        ],
+        'version': '17.03.01',
+        'image': 'flash:packages.conf',
+        'flash': ['packages.conf'],
+        'data': {'stack': {'1': 'FOC2222X0B1', '2': 'FOC2222X0B2'},
+                 'subst': {'hostname': 'access2'}},
+    },
+    # single switch in bundle mode running an older version, installs image
+    'bundle': {
+        'chassis': None,
+        'platform': 'C9300-48P',
+        'switches': [
+            {'number': 1, 'serial': 'FOC2222X0C1', 'priority': 1,
+             'state': 'Ready'},
+        ],
+        'version': '16.12.04',
+        'image': 'flash:cat9k_iosxe.16.12.04.SPA.bin',
+        'flash': ['cat9k_iosxe.16.12.04.SPA.bin'],
+        'data': {'stack': {'1': 'FOC2222X0C1'},
+                 'subst': {'hostname': 'access3'}},
+    },
+    # configuration template without indentation of sub-commands
+    'flat': {
+        'chassis': None,
+        'platform': 'C9300-24T',
+        'switches': [
+            {'number': 1, 'serial': 'FOC2222X0D1', 'priority': 1,
+             'state': 'Ready'},
+        ],
+        'version': '17.03.01',
+        'image': 'flash:packages.conf',
+        'flash': ['packages.conf'],
+        'running': ['interface GigabitEthernet1/0/1',
+                    'interface GigabitEthernet1/0/2'],
+        'files': {'configs/flat.cfg': FLAT},
+        'data': {'stack': {'1': 'FOC2222X0D1'},
+                 'config': 'configs/flat.cfg',
+                 'subst': {'hostname': 'access4'}},
+    },
+}
@@ -0,0 +1,219 @@
+""" Device Benchmark
+This script starts app.py on the loopback interface and runs the main()
+workflow of script.py against it for simulated devices, using the cli package
+in this directory instead of the cli module of the guestshell. Every device
+profile is provisioned once:
+- chassis   : applies the configuration and executes final commands
+- stack     : same for a stack of two switches
+- v-mismatch: starts autoupgrade
+- bundle    : changes the boot mode and installs the target image
+- flat      : applies a template without indentation of sub-commands
+
+The number of CLI calls and the wall time are reported per phase, the time
+spent in main() outside the phases, like the syslog setup, is reported as
+other. Latency of CLI calls is set per command prefix, like
+--latency default=0.05,copy=0.5,configure=0.2
+With --rerun every profile is provisioned a second time with the running
+configuration left by the first run, like a partially provisioned device.
+
+Usage: python bench/device_bench.py [--profiles NAME,NAME] [--latency SPEC]
+                                    [--more] [--rerun] [--verbose]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+try:
+    from importlib import reload
+except ImportError:
+    pass  # builtin on Python 2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import cli  # simulator in this directory, found before ROOT
+import script
+
+# functions of script.py that main() calls, in workflow order
+PHASES = ('serials', 'get_version', 'download', 'blue_beacon', 'flush_log',
+          'install', 'autoupgrade', 'renumber_stack', 'apply_config',
+          'final_cli', 'upload', 'shutdown')
+IMAGE = 'cat9k_iosxe.17.03.01.SPA.bin'
+
+class Timer():
+    """ Wall time and CLI calls of the phases, the outermost phase counts """
+    def __init__(self):
+        """ Initializes empty totals """
+        self.totals = {}
+        self.depth = 0
+
+    def wrap(self, name, func):
+        """ Returns function that adds its time and CLI calls to phase """
+        def wrapper(*args, **kwargs):
+            if self.depth:
+                return func(*args, **kwargs)
+
+            self.depth += 1
+            start, count = time.time(), len(cli.calls)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.depth -= 1
+                seconds, calls = self.totals.get(name, (0, 0))
+                self.totals[name] = (seconds + time.time() - start,
+                                     calls + len(cli.calls) - count)
+        return wrapper
+
+def wait_for_port(port, timeout=10):
+    """ Waits until server accepts connections """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('Server did not start')
+
+def prepare(folder, port, profiles, image):
+    """ Creates dataset with the device profiles, a config and an image """
+    for name in ('images', 'configs'):
+        os.mkdir(os.path.join(folder, name))
+
+    with open(os.path.join(folder, 'images', IMAGE), 'wb') as outfile:
+        outfile.write(os.urandom(image * 1024))
+
+    with open(os.path.join(folder, 'configs', 'base.cfg'), 'w') as outfile:
+        outfile.write('hostname $hostname\n')
+        for number in range(1, 49):
+            outfile.write('interface GigabitEthernet1/0/%d\n'
+                          ' description $hostname port %d\n'
+                          ' switchport mode access\n!\n' % (number, number))
+
+    data = [{'base_url': 'http://127.0.0.1:%d/file/' % port,
+             'install': 'images/' + IMAGE, 'version': '17.03.01',
+             'config': 'configs/base.cfg'}]
+    for profile in profiles.values():
+        for path, text in profile.get('files', {}).items():
+            with open(os.path.join(folder, path), 'w') as outfile:
+                outfile.write(text)
+    data.extend(profile['data'] for profile in profiles.values())
+    with open(os.path.join(folder, 'data.json'), 'w') as outfile:
+        json.dump(data, outfile, indent=4)
+
+def run(profile, port, args):
+    """ Runs main() of a fresh script.py for profile and returns tuple of
+    status, wall time, phase totals and device """
+    flash = tempfile.mkdtemp()
+    try:
+        cli.load(profile, flash)
+        module = reload(script)
+        url = 'http://127.0.0.1:%d' % port
+        module.LOGAPI = url + '/log'
+        module.JSON = url + '/data'
+        module.CONFIGAPI = url + '/config'
+        module.MD5API = url + '/md5'
+        module.GUEST_SHARE = not args.more
+        module.GUEST_SHARE_DIR = os.path.join(flash, 'guest-share')
+        timer = Timer()
+        for name in PHASES:
+            owner = module.facts if name == 'serials' else module
+            setattr(owner, name, timer.wrap(name, getattr(owner, name)))
+
+        stdout = sys.stdout
+        if not args.verbose:
+            sys.stdout = open(os.devnull, 'w')
+        start = time.time()
+        try:
+            module.main()
+        except SystemExit:
+            pass
+        finally:
+            wall = time.time() - start
+            if not args.verbose:
+                sys.stdout.close()
+                sys.stdout = stdout
+        return module.ztp.get('status', 'Upgrading'), wall, timer.totals, \
+            cli.device
+    finally:
+        shutil.rmtree(flash)
+
+def parse_latency(spec):
+    """ Returns dict with seconds by command prefix, default is all commands """
+    latency = {}
+    for item in spec.split(','):
+        if item.strip():
+            prefix, seconds = item.rsplit('=', 1)
+            prefix = prefix.strip()
+            latency['' if prefix == 'default' else prefix] = float(seconds)
+    return latency
+
+def report(name, status, wall, totals):
+    """ Prints a line per phase and a line with the totals of the run """
+    calls = len(cli.calls)
+    for phase in PHASES:
+        if phase in totals:
+            print('%-12s %-16s %7d %10.1f'
+                  % (name, phase, totals[phase][1], totals[phase][0] * 1000))
+    print('%-12s %-16s %7d %10.1f'
+          % (name, 'other', calls - sum(t[1] for t in totals.values()),
+             (wall - sum(t[0] for t in totals.values())) * 1000))
+    print('%-12s %-16s %7d %10.1f' % (name, 'total: ' + status, calls,
+                                      wall * 1000))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profiles', default=','.join(sorted(cli.PROFILES)),
+                        help='device profiles (default all)')
+    parser.add_argument('--latency', default='',
+                        help='seconds per command prefix, like default=0.05')
+    parser.add_argument('--image', type=int, default=1024,
+                        help='image size in KB (default 1024)')
+    parser.add_argument('--more', action='store_true',
+                        help='download with more instead of guest-share')
+    parser.add_argument('--rerun', action='store_true',
+                        help='run again with the resulting configuration')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show script output and device events')
+    parser.add_argument('--port', type=int, default=18081)
+    args = parser.parse_args()
+    cli.LATENCY.update(parse_latency(args.latency))
+    profiles = dict((name, cli.PROFILES[name])
+                    for name in args.profiles.split(','))
+
+    folder = tempfile.mkdtemp()
+    try:
+        prepare(folder, args.port, profiles, args.image)
+        with open(os.devnull, 'w') as devnull:
+            server = subprocess.Popen([sys.executable,
+                                       os.path.join(ROOT, 'app.py'),
+                                       '--host', '127.0.0.1',
+                                       '--port', str(args.port)],
+                                      cwd=folder, stdout=devnull,
+                                      stderr=devnull)
+        try:
+            wait_for_port(args.port)
+            print('%-12s %-16s %7s %10s' % ('profile', 'phase', 'calls', 'ms'))
+            for name in args.profiles.split(','):
+                profile = profiles[name]
+                for label in [name, name + '*'][:2 if args.rerun else 1]:
+                    status, wall, totals, device = run(profile, args.port,
+                                                       args)
+                    report(label, status, wall, totals)
+                    if args.verbose:
+                        for event in device.events:
+                            print('event: %s' % event)
+                    profile = dict(profile, running=device.config)
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+""" Download Benchmark
+This script compares the ways script.py recovers a downloaded file on the
+device: the former parsing of the IOS more command output, which decoded the
+hex dump line by line, the current parsing, which decodes the hex dump at once,
+and reading the file from the guest-share folder after it has been copied.
+Captured more command outputs can be given as arguments, otherwise hex dumps of
+datasets of several sizes are generated. The copy command itself runs in IOS
+and is not part of the measurement.
+
+Usage: python bench/download_bench.py [--rounds N] [capture ...]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import types
+import base64
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+URL = 'http://10.0.0.1:8080/data'
+
+def load_script():
+    """ Returns script.py as module, the cli module only exists on IOS XE """
+    sys.modules.setdefault('cli', types.ModuleType('cli'))
+    sys.path.insert(0, ROOT)
+    import script
+    return script
+
+def more_output(data):
+    """ Returns byte string formatted like the hex output of the more command """
+    lines = ['Loading %s ' % URL]
+    for offset in range(0, len(data), 16):
+        chunk = base64.b16encode(data[offset:offset + 16]).decode('ascii')
+        chunk = chunk.ljust(32, 'X')
+        words = ' '.join(chunk[i:i + 8] for i in range(0, 32, 8))
+        text = ''.join(chr(c) if 32 <= c < 127 else '.'
+                       for c in bytearray(data[offset:offset + 16]))
+        lines.append('%08X: %s    %s' % (offset, words, text))
+    return '\n'.join(lines)
+
+def dataset(stacks):
+    """ Returns JSON encoded dataset with given number of stacks """
+    data = [{'base_url': 'http://10.0.0.1:8080/file/', 'version': '17.03.01',
+             'install': 'images/cat9k_iosxe.17.03.01.SPA.bin'}]
+    for number in range(stacks):
+        data.append({'stack': {'1': 'FOC%08d' % number,
+                               '2': 'FOC%08d' % (number + stacks)},
+                     'subst': {'hostname': 'switch%d' % number}})
+    return json.dumps(data).encode('utf-8')
+
+def former_parse(result):
+    """ Former implementation, byte strings are joined to run on Python 3 """
+    match = re.search('^Loading %s (.*)' % URL, result, re.DOTALL)
+    fmt = match.group(1) if match else ''
+    match = re.findall(r'\S{8}: +(\S{8} +\S{8} +\S{8} +\S{8})', fmt)
+    parts = [base64.b16decode(re.sub(' |X', '', line)) for line in match]
+    return b''.join(parts) if match else fmt
+
+def current_parse(script, result):
+    """ Current implementation of download() after the more command """
+    match = re.search('^Loading %s (.*)' % re.escape(URL), result, re.DOTALL)
+    return script.parse_hex(match.group(1)) if match else ''
+
+def guest_share(script, path):
+    """ Current implementation of copy_file() after the copy command """
+    with open(path, 'rb') as infile:
+        return script.to_str(infile.read())
+
+def measure(func, rounds):
+    """ Returns best time of rounds in seconds """
+    best = None
+    for _ in range(rounds):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='rounds per case (default 5)')
+    parser.add_argument('--stacks', default='100,1000,10000',
+                        help='generated dataset sizes (default 100,1000,10000)')
+    parser.add_argument('capture', nargs='*',
+                        help='file with captured more command output')
+    args = parser.parse_args()
+    script = load_script()
+
+    cases = []
+    for filename in args.capture:
+        with open(filename) as infile:
+            result = infile.read()
+        if not result.startswith('Loading '):
+            result = 'Loading %s %s' % (URL, result)
+        else:
+            result = re.sub('^Loading \\S+ ', 'Loading %s ' % URL, result)
+        cases.append((os.path.basename(filename), result))
+    if not args.capture:
+        for stacks in [int(n) for n in args.stacks.split(',')]:
+            cases.append(('%d stacks' % stacks, more_output(dataset(stacks))))
+
+    print('%-20s %10s %12s %12s %12s' % ('case', 'KB', 'former ms',
+                                         'current ms', 'copy ms'))
+    for name, result in cases:
+        data = current_parse(script, result)
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                outfile.write(data.encode('utf-8'))
+            times = [measure(lambda: former_parse(result), args.rounds),
+                     measure(lambda: current_parse(script, result), args.rounds),
+                     measure(lambda: guest_share(script, path), args.rounds)]
+        finally:
+            os.remove(path)
+        print('%-20s %10d %12.1f %12.1f %12.1f'
+              % ((name, len(data) // 1024) + tuple(t * 1000 for t in times)))
+
+if __name__ == '__main__':
+    main()
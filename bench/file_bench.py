@@ -0,0 +1,134 @@
+""" File Transfer Benchmark
+This script compares the transfer path of GET /file in app.py with the former
+implementation, that served every file using bottle.static_file, on the
+loopback interface. A test image is downloaded by a number of concurrent
+clients, as a whole and as two byte ranges to simulate resumed transfers.
+Throughput and latency are reported for both paths.
+
+Usage: python bench/file_bench.py [--size MB] [--clients N] [--rounds N]
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def serve(port, folder):
+    """ Runs app.py with an extra route for the former implementation """
+    os.chdir(folder)
+    sys.path.insert(0, ROOT)
+    logging.getLogger('waitress').setLevel(logging.ERROR)
+    import bottle
+    import app
+
+    @bottle.get('/static/<filepath:path>')
+    def get_static(filepath):
+        """ Former implementation of GET /file """
+        return bottle.static_file(filepath, root='.')
+
+    bottle.run(host='127.0.0.1', port=port, server='waitress', quiet=True)
+
+def wait_for_port(port, timeout=10):
+    """ Waits until server accepts connections """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('Server did not start')
+
+def download(port, path, headers, results):
+    """ Downloads URL path and appends tuple of bytes and seconds to results """
+    start = time.time()
+    conn = HTTPConnection('127.0.0.1', port, timeout=300)
+    conn.request('GET', path, headers=headers)
+    resp = conn.getresponse()
+    size = 0
+    while True:
+        chunk = resp.read(1024 * 1024)
+        if not chunk:
+            break
+        size += len(chunk)
+    conn.close()
+    if resp.status not in (200, 206):
+        raise RuntimeError('%s returned %d' % (path, resp.status))
+    results.append((size, time.time() - start))
+
+def run(port, path, clients, headers):
+    """ Returns tuple of total bytes, wall time and sorted latencies """
+    results = []
+    threads = [threading.Thread(target=download,
+                                args=(port, path, headers, results))
+               for _ in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - start
+    return sum(r[0] for r in results), wall, sorted(r[1] for r in results)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=256,
+                        help='image size in MB (default 256)')
+    parser.add_argument('--clients', type=int, default=16,
+                        help='concurrent clients (default 16)')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='rounds per path (default 3)')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        return serve(args.port, args.serve)
+
+    folder = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(folder, 'images'))
+        size = args.size * 1024 * 1024
+        with open(os.path.join(folder, 'images', 'test.bin'), 'wb') as outfile:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size):
+                outfile.write(block)
+
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                   '--port', str(args.port), '--serve', folder])
+        try:
+            wait_for_port(args.port)
+            half = size // 2
+            cases = [('full', {}),
+                     ('range', {'Range': 'bytes=%d-' % half})]
+            print('%-8s %-6s %10s %10s %10s' % ('path', 'case', 'MB/s',
+                                                'p50 s', 'max s'))
+            for prefix in ('/static/', '/file/'):
+                for case, headers in cases:
+                    for _ in range(args.rounds):
+                        total, wall, lat = run(args.port,
+                                               prefix + 'images/test.bin',
+                                               args.clients, headers)
+                        print('%-8s %-6s %10.1f %10.3f %10.3f'
+                              % (prefix.strip('/'), case,
+                                 total / wall / 1e6, lat[len(lat) // 2],
+                                 lat[-1]))
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+""" Fleet Benchmark
+This script starts app.py on the loopback interface and replays a provisioning
+wave of simulated switches against it. Every switch runs the requests of
+script.py in order:
+- GET /data (or GET /data/<serial> with --lookup)
+- GET /file for the configuration file
+- GET /file for the image in byte ranges
+- PUT /log with the lines added since the previous upload, like upload() does
+
+The wave is repeated for every combination of dataset size and number of
+Waitress threads. Throughput and p50/p95/p99 latency are reported per endpoint.
+
+Usage: python bench/fleet_bench.py [--switches N] [--stacks N,N]
+                                   [--threads N,N] [--image MB]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINTS = ('data', 'config', 'image', 'log')
+
+def serve(port, folder, threads):
+    """ Runs app.py with given number of Waitress threads """
+    os.chdir(folder)
+    sys.path.insert(0, ROOT)
+    logging.getLogger('waitress').setLevel(logging.ERROR)
+    import bottle
+    import app
+
+    bottle.run(host='127.0.0.1', port=port, server='waitress', quiet=True,
+               threads=threads)
+
+def wait_for_port(port, timeout=10):
+    """ Waits until server accepts connections """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('Server did not start')
+
+def serial(number):
+    """ Returns serial number of simulated switch """
+    return 'FOC%08d' % number
+
+def prepare(folder, port, stacks, image):
+    """ Creates dataset with given number of stacks, a config and an image """
+    for name in ('images', 'configs'):
+        os.mkdir(os.path.join(folder, name))
+
+    with open(os.path.join(folder, 'images', 'test.bin'), 'wb') as outfile:
+        block = os.urandom(1024 * 1024)
+        for _ in range(image):
+            outfile.write(block)
+
+    with open(os.path.join(folder, 'configs', 'base.cfg'), 'w') as outfile:
+        outfile.write('hostname $hostname\n')
+        for number in range(1, 49):
+            outfile.write('interface GigabitEthernet1/0/%d\n'
+                          ' description $hostname port %d\n'
+                          ' switchport mode access\n!\n' % (number, number))
+
+    data = [{'base_url': 'http://127.0.0.1:%d/file/' % port,
+             'install': 'images/test.bin', 'version': '17.03.01',
+             'config': 'configs/base.cfg', 'subst': {'hostname': 'switch'}}]
+    for number in range(stacks):
+        data.append({'stack': {'1': serial(number)},
+                     'subst': {'hostname': 'switch%d' % number}})
+
+    with open(os.path.join(folder, 'data.json'), 'w') as outfile:
+        json.dump(data, outfile, indent=4)
+
+def request(conn, method, path, body=None, headers=None):
+    """ Returns tuple of status and seconds until the response is read """
+    start = time.time()
+    conn.request(method, path, body, headers or {})
+    resp = conn.getresponse()
+    while resp.read(1024 * 1024):
+        pass
+    return resp.status, time.time() - start
+
+def switch(port, number, args, results):
+    """ Runs the requests of one switch and appends them to results """
+    conn = HTTPConnection('127.0.0.1', port, timeout=300)
+    record = lambda name, result: results.append((name,) + result)
+    try:
+        path = '/data/%s' % serial(number) if args.lookup else '/data'
+        record('data', request(conn, 'GET', path))
+        record('config', request(conn, 'GET', '/file/configs/base.cfg'))
+        size = args.image * 1024 * 1024
+        chunk = max(size // args.ranges, 1)
+        for start in range(0, size, chunk):
+            headers = {'Range': 'bytes=%d-%d' % (start, start + chunk - 1)}
+            record('image', request(conn, 'GET', '/file/images/test.bin',
+                                    headers=headers))
+
+        ztp = {'serial': serial(number), 'version': '16.12.04',
+               'run': '%016x' % number, 'offset': 0}
+        statuses = ['Upgrading'] * (args.logs - 1) + ['Finished']
+        for seq, status in enumerate(statuses, 1):
+            ztp['logbuf'] = '\n' + 'Applying configuration...\n' * 40
+            ztp.update(status=status, seq=seq)
+            body = json.dumps(ztp)
+            ztp['offset'] += len(ztp['logbuf'])
+            record('log', request(conn, 'PUT', '/log', body,
+                                  {'Content-Type': 'application/json'}))
+    except (socket.error, IOError) as e:
+        results.append(('error', 0, str(e)))
+    finally:
+        conn.close()
+
+def wave(port, args):
+    """ Returns wall time and results of all switches """
+    results = []
+    threads = [threading.Thread(target=switch,
+                                args=(port, number, args, results))
+               for number in range(args.switches)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start, results
+
+def percentile(values, fraction):
+    """ Returns value at fraction of sorted values """
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def report(stacks, threads, wall, results):
+    """ Prints a line with throughput and latencies per endpoint """
+    errors = [r for r in results if r[0] == 'error' or r[1] not in (200, 206)]
+    for name in ENDPOINTS:
+        latencies = sorted(r[2] for r in results if r[0] == name)
+        if not latencies:
+            continue
+        print('%7d %7d %-7s %7d %9.1f %9.1f %9.1f %9.1f'
+              % (stacks, threads, name, len(latencies),
+                 len(latencies) / wall,
+                 percentile(latencies, 0.50) * 1000,
+                 percentile(latencies, 0.95) * 1000,
+                 percentile(latencies, 0.99) * 1000))
+    if errors:
+        print('%d failed requests, first: %r' % (len(errors), errors[0]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--switches', type=int, default=100,
+                        help='simulated switches per wave (default 100)')
+    parser.add_argument('--stacks', default='100,1000,10000',
+                        help='dataset sizes (default 100,1000,10000)')
+    parser.add_argument('--threads', default='4,16',
+                        help='Waitress thread counts (default 4,16)')
+    parser.add_argument('--image', type=int, default=16,
+                        help='image size in MB (default 16)')
+    parser.add_argument('--ranges', type=int, default=4,
+                        help='byte ranges per image download (default 4)')
+    parser.add_argument('--logs', type=int, default=4,
+                        help='log uploads per switch (default 4)')
+    parser.add_argument('--lookup', action='store_true',
+                        help='fetch /data/<serial> instead of /data')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        return serve(args.port, args.serve, int(args.threads))
+
+    print('%7s %7s %-7s %7s %9s %9s %9s %9s'
+          % ('stacks', 'threads', 'request', 'count', 'req/s',
+             'p50 ms', 'p95 ms', 'p99 ms'))
+    for stacks in [int(n) for n in args.stacks.split(',')]:
+        folder = tempfile.mkdtemp()
+        try:
+            prepare(folder, args.port, stacks, args.image)
+            for threads in [int(n) for n in args.threads.split(',')]:
+                server = subprocess.Popen([sys.executable,
+                                           os.path.abspath(__file__),
+                                           '--port', str(args.port),
+                                           '--threads', str(threads),
+                                           '--serve', folder])
+                try:
+                    wait_for_port(args.port)
+                    wall, results = wave(args.port, args)
+                    report(stacks, threads, wall, results)
+                finally:
+                    server.terminate()
+                    server.wait()
+                shutil.rmtree(os.path.join(folder, '.log'), True)
+        finally:
+            shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    main()
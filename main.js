@@ -299,6 +299,7 @@ function loadData(ignoreBody) {
     xhttp.onreadystatechange = function() {
         if (this.readyState == 4) {
             submitData.lastModified = this.getResponseHeader('Last-Modified');
+            submitData.etag = this.getResponseHeader('ETag');
 			if (ignoreBody) return;
             removeContent(document.getElementById('stacks'));
             removeContent(document.getElementById('defaults'));
@@ -362,7 +363,11 @@ function loadList() {
                 var cell = row.insertCell(-1);
                 cell.appendChild(createLink('Download', '/file/' + files[index].file, null));
                 cell.appendChild(document.createTextNode(' '));
-                cell.appendChild(createLink('Remove', null, function() {deleteFile(this)}));
+                // Files referred to by the dataset cannot be removed
+                if (files[index].used)
+                    cell.appendChild(document.createTextNode('In use'));
+                else
+                    cell.appendChild(createLink('Remove', null, function() {deleteFile(this)}));
             }
             document.getElementById('files').appendChild(table);
             updateOptionsFromTable();
@@ -480,6 +485,102 @@ function importCsv() {
     document.getElementById('form_import').reset();
 }
 
+function appendLogRow(table, entry) {
+    // Replace row of previous upload of the same run
+    if (entry['run']) {
+        for (var index = 1; index < table.rows.length; index++) {
+            if (table.rows[index].getAttribute('data-run') == entry['run']) {
+                table.deleteRow(index);
+                break;
+            }
+        }
+    }
+    var row = table.insertRow(-1);
+    if (entry['run']) row.setAttribute('data-run', entry['run']);
+    row.insertCell(-1).innerHTML = entry['ip'];
+    row.insertCell(-1).innerHTML = entry['time'];
+    row.insertCell(-1).innerHTML = entry['serial'];
+    row.insertCell(-1).innerHTML = entry['version'];
+    row.insertCell(-1).innerHTML = entry['status'];
+    var cell = row.insertCell(-1);
+    ['logbuf', 'cli'].forEach(function(key) {
+        if (typeof entry[key] !== 'undefined') {
+            cell.appendChild(createLink(key, null, openModal(key, entry[key])));
+            cell.appendChild(document.createTextNode(' '));
+        }
+    });
+}
+
+function logAdded(entry) {
+    // Append new log entry or reload log if there is no table yet
+    var table = document.getElementById('table_log');
+    table ? appendLogRow(table, entry) : loadLog();
+}
+
+function dataChanged(etag) {
+    // Give own submits time to update the entity tag
+    setTimeout(function() {
+        // Entity tags of the gzip compressed and plain dataset differ by suffix
+        var current = submitData.etag ? submitData.etag.replace('-gzip"', '"') : null;
+        if (etag.replace('-gzip"', '"') != current && confirm('Dataset was changed on the server. Reload?')) loadData(false);
+    }, 2000);
+}
+
+function watchEvents() {
+    var source = new EventSource('/events');
+    source.addEventListener('log', function(e) {
+        logAdded(JSON.parse(e.data));
+    }, false);
+    source.addEventListener('data', function(e) {
+        dataChanged(JSON.parse(e.data).etag);
+    }, false);
+    source.onerror = function() {
+        // Server refused stream, poll until it is time to try again
+        if (source.readyState == EventSource.CLOSED) pollEvents(null, null, Date.now() + 30000);
+    };
+}
+
+function pollEvents(cursor, etag, until) {
+    // Ask for log entries after cursor, or for the cursor of the newest entry
+    var xhttp = new XMLHttpRequest();
+    xhttp.onreadystatechange = function() {
+        if (this.readyState == 4) {
+            var more = false;
+            if (this.status == 200) {
+                var page = JSON.parse(this.responseText);
+                if (cursor !== null) page.entries.forEach(logAdded);
+                cursor = page.last || cursor || '0';
+                more = page.next !== null;
+            }
+            pollData(etag, function(current) {
+                if (Date.now() >= until) {
+                    watchEvents();
+                } else {
+                    setTimeout(function() { pollEvents(cursor, current, until); }, more ? 0 : 5000);
+                }
+            });
+        }
+    };
+    xhttp.open("GET", cursor === null ? "/log?order=desc&limit=1" : "/log?cursor=" + cursor, true);
+    xhttp.setRequestHeader('X-Requested-With', 'XMLHttpRequest');
+    xhttp.send();
+}
+
+function pollData(etag, done) {
+    // Compare entity tag of the dataset with the one of the previous poll
+    var xhttp = new XMLHttpRequest();
+    xhttp.onreadystatechange = function() {
+        if (this.readyState == 4) {
+            var current = (this.status == 200) ? this.getResponseHeader('ETag') : etag;
+            if (etag !== null && current != etag) dataChanged(current);
+            done(current);
+        }
+    };
+    xhttp.open("HEAD", "/data", true);
+    xhttp.setRequestHeader('X-Requested-With', 'XMLHttpRequest');
+    xhttp.send();
+}
+
 function loadLog() {
     var log = document.getElementById('log');
     removeContent(log);
@@ -505,19 +606,7 @@ function loadLog() {
                     row.appendChild(cell);
                 });
                 for (var index = 0; index < entries.length; index++) {
-                    var row = table.insertRow(-1);
-                    row.insertCell(-1).innerHTML = entries[index]['ip'];
-                    row.insertCell(-1).innerHTML = entries[index]['time'];
-                    row.insertCell(-1).innerHTML = entries[index]['serial'];
-                    row.insertCell(-1).innerHTML = entries[index]['version'];
-                    row.insertCell(-1).innerHTML = entries[index]['status'];
-                    var cell = row.insertCell(-1);
-                    ['logbuf', 'cli'].forEach(function(key) {
-                        if (typeof entries[index][key] !== 'undefined') {
-                            cell.appendChild(createLink(key, null, openModal(key, entries[index][key])));
-                            cell.appendChild(document.createTextNode(' '));
-                        }
-                    });
+                    appendLogRow(table, entries[index]);
                 }
                 log.appendChild(table);
             } else {
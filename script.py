@@ -6,7 +6,9 @@ registration. A simple web server can be used to serve the script and software
 to the device and standard syslog server can be used for script monitoring.
 Finally, a DHCP server configured for option 67 is required.
 
-Adapt the SYSLOG, JSON and DATA constants to your needs.
+Adapt the 8 constants SYSLOG, LOGAPI, JSON, LOOKUP, CONFIGAPI, GUEST_SHARE,
+MD5API and DATA to your needs. Without the GUI app, set LOGAPI, JSON, CONFIGAPI
+and MD5API to empty strings, as they default to the API URLs of the GUI app.
 
 Supported platforms, software versions and other details can be found at:
 https://cs.co/ztp_provisioning
@@ -20,13 +22,13 @@ import re
 import sys
 import json
 import time
-import base64
+import binascii
 from string import Template
 from xml.dom import minidom
 try:
-    from urlparse import urljoin
+    from urlparse import urljoin, urlparse
 except ImportError:
-    from urllib.parse import urljoin
+    from urllib.parse import urljoin, urlparse
 import cli
 
 ##### CONSTANTS ################################################################
@@ -38,6 +40,28 @@ LOGAPI = 'http://10.0.0.1:8080/log'  # URL to log API, empty string disables
 # Empty string disables downloading of external device data.
 JSON = 'http://10.0.0.1:8080/data'
 
+# LOOKUP is a boolean to download only the defaults and the matching stack from
+# the JSON URL suffixed with the serial numbers of the device. Requires the GUI
+# app to serve the data, set to False if JSON is the URL of a plain file.
+LOOKUP = True
+
+# CONFIGAPI is a string with URL of the GUI app API that serves configurations
+# rendered on the server. It is suffixed with the serial number of the device.
+# Empty string or a failed download renders the configuration on the device.
+CONFIGAPI = 'http://10.0.0.1:8080/config'
+
+# GUEST_SHARE is a boolean to download files by copying them to the guest-share
+# folder of bootflash and reading them from the guestshell file system. Set to
+# False to always parse the output of the IOS more command instead, which is
+# also used if copying fails.
+GUEST_SHARE = True
+
+# MD5API is a string with URL of the GUI app API that serves the MD5 digest of
+# a file. An image that is already on flash, for instance from an interrupted
+# attempt, is installed from flash if its MD5 digest matches. Requires a
+# relative install path. Empty string disables the check.
+MD5API = 'http://10.0.0.1:8080/md5'
+
 # DATA is a list of dicts that defines device data. To specify device defaults,
 # omit the key named 'stack' from one dict. Empty list disables the internal
 # data of the script. Valid keys and values are:
@@ -54,54 +78,297 @@ DATA = []
 
 ##### GLOBALS ##################################################################
 
-ztp = dict(logbuf='')
+# line of the hex/text format of the IOS more command
+HEX_LINE = re.compile(r'\S{8}: +(\S{8} +\S{8} +\S{8} +\S{8})')
+
+# maximum length of the send log commands that are sent in one CLI call
+BATCH_SIZE = 2000
+
+# maximum number of configuration lines that are applied in one CLI call
+CONFIG_BATCH = 200
+
+# top-level configuration commands that enter a sub-mode
+PARENT = re.compile(r'^(interface|router|line|vlan|vrf|ip(v6)? access-list|'
+                    r'(class|policy|route|parameter)-map|ip dhcp pool|aaa |'
+                    r'(radius|tacacs) server|crypto|key chain|track|archive|'
+                    r'event manager applet|spanning-tree mst configuration|'
+                    r'redundancy|control-plane|flow |object-group|template|'
+                    r'device-tracking policy|license smart|netconf-yang|'
+                    r'call-home|snmp-server (view|group)\b)')
+
+# guest-share folder of bootflash in the guestshell file system
+GUEST_SHARE_DIR = '/bootflash/guest-share'
+
+# identifies the log entries of this run, which are merged by the GUI app
+RUN = binascii.hexlify(os.urandom(8)).decode('ascii')
+
+ztp = dict()
+logbuf = []  # log lines, joined when uploaded
+syslog = []  # send log commands waiting to be flushed
+# sequence number of last upload and what the last successful upload contained
+sent = dict(seq=0, lines=0, chars=0, calls=0, state={})
 
 ##### CLASSES ##################################################################
 
+class DataIndex():
+    """ Index of device data by serial number. The JSON text is parsed one
+    dict at a time and only the position of each dict in the text is kept, so
+    a dict is decoded again when it is looked up """
+    def __init__(self, data, json_str=''):
+        """ Initializes object with list of dicts and JSON text of a list of
+        dicts, which follows the list. Raises ValueError if text is invalid """
+        self.json_str = json_str
+        self.decoder = json.JSONDecoder()
+        self.defaults = None  # first defaults dict or its span in JSON text
+        self.serials = {}  # order and stack dict or its span by serial number
+        for order, dct in enumerate(data):
+            self.add(dct, (order, dct))
+
+        if json_str:
+            for dct, span in self.parse(json_str):
+                self.add(dct, (len(data) + span[0], span))
+
+    def parse(self, text):
+        """ Yields tuples of dict and its start and end in JSON text """
+        space = re.compile(r'\s*')
+        pos = space.match(text).end()
+        if text[pos:pos + 1] != '[':
+            raise ValueError('Expecting JSON array at position %d' % pos)
+
+        pos = space.match(text, pos + 1).end()
+        if text[pos:pos + 1] == ']':
+            return
+
+        while True:
+            dct, end = self.decoder.raw_decode(text, pos)
+            yield dct, (pos, end)
+            pos = space.match(text, end).end()
+            if text[pos:pos + 1] == ']':
+                return
+            if text[pos:pos + 1] != ',':
+                raise ValueError("Expecting ',' delimiter at position %d" % pos)
+
+            pos = space.match(text, pos + 1).end()
+
+    def add(self, dct, entry):
+        """ Indexes tuple of order and dict or span, the first defaults and
+        the first stack of a serial win """
+        if not isinstance(dct, dict):
+            return
+
+        # absence of stack key indicates defaults dict
+        if 'stack' not in dct:
+            if self.defaults is None:
+                self.defaults = entry[1]
+        else:
+            for serial in dct['stack'].values():
+                self.serials.setdefault(serial, entry)
+
+    def get(self, value):
+        """ Returns dict, decoded from JSON text if value is a span """
+        if isinstance(value, tuple):
+            return self.decoder.raw_decode(self.json_str, value[0])[0]
+
+        return value if value is not None else {}
+
+    def lookup(self, serials):
+        """ Returns first stack dict with any of the serials or empty dict """
+        entries = [self.serials[sn] for sn in serials if sn in self.serials]
+        return self.get(min(entries, key=lambda entry: entry[0])[1]) \
+            if entries else {}
+
 class Stack():
     """ Object with matching device data. Provides attribute-like access """
-    def __init__(self, data, serials):
-        """ Initializes object with data and serials """
-        # absence of stack key indicates defaults dict
-        self.defaults = next((dct for dct in data if not 'stack' in dct), {})
+    def __init__(self, index, serials):
+        """ Initializes object with data index and serials """
+        self.defaults = index.get(index.defaults)
         # find dict with at least one common serial number in stack dict
-        self.stack_dict = next((dct for dct in data if 'stack' in dct
-                                and len(set(dct['stack'].values())
-                                        & set(serials.values()))), {})
+        self.stack_dict = index.lookup(serials.values())
 
     def __getattr__(self, name):
         """ x.__getattr__(y) <==> x.y """
         return self.stack_dict.get(name, self.defaults.get(name, None))
 
+class Facts():
+    """ Device facts parsed from show commands. Each command is executed at
+    most once, until it is invalidated by a command that changes state """
+    def __init__(self):
+        """ Initializes empty cache """
+        self.cache = {}
+
+    def show(self, command):
+        """ Returns output of show command, executes it only once """
+        if command not in self.cache:
+            self.cache[command] = cli.execute(command)
+
+        return self.cache[command]
+
+    def invalidate(self, command):
+        """ Forgets output of show command after a change of state """
+        self.cache.pop(command, None)
+
+    def serials(self):
+        """ Returns dict with switch number as key and serial as value """
+        doc = minidom.parseString(self.show('show inventory | format'))
+        serials = {}
+        for node in doc.getElementsByTagName('InventoryEntry'):
+            chassis = node.getElementsByTagName('ChassisName')[0]
+            # non-stackable
+            if chassis.firstChild.data == '"Chassis"':
+                serials[0] = node.getElementsByTagName('SN')[0].firstChild.data
+
+            # stackable
+            match = re.match('"Switch ([0-9])"', chassis.firstChild.data)
+            if match:
+                unit = int(match.group(1))
+                serials[unit] = node.getElementsByTagName('SN')[0] \
+                    .firstChild.data
+
+        return serials
+
+    def platform(self):
+        """ Returns product ID of the chassis or first switch or 'unknown' """
+        doc = minidom.parseString(self.show('show inventory | format'))
+        for node in doc.getElementsByTagName('InventoryEntry'):
+            chassis = node.getElementsByTagName('ChassisName')[0]
+            pid = node.getElementsByTagName('PID')
+            if re.match('"(Chassis|Switch [0-9])"', chassis.firstChild.data) \
+                    and pid and pid[0].firstChild:
+                return pid[0].firstChild.data.strip()
+
+        return 'unknown'
+
+    def priorities(self):
+        """ Returns dict with switch number as key and priority as value """
+        match = re.findall(r'(\d)\s+\S+\s+\S+\s+(\d+)', self.show('show switch'))
+        return dict((int(num), int(prio)) for num, prio in match)
+
+    def active(self):
+        """ Returns number of the active switch or None """
+        match = re.search(r'\*(\d)', self.show('show switch'))
+        return int(match.group(1)) if match else None
+
+    def v_mismatch(self):
+        """ Returns True if a switch is in version mismatch state """
+        return 'V-Mismatch' in self.show('show switch')
+
+    def version(self):
+        """ Returns version string without leading zeros in numbers """
+        match = re.search('Version ([A-Za-z0-9.:()]+)', self.show('show version'))
+        return re.sub(r'\b0+(\d)', r'\1', match.group(1)) if match \
+            else 'unknown'
+
+    def boot_image(self):
+        """ Returns URL of the image the device booted from or None """
+        match = re.search('System image file is "(.*)"',
+                          self.show('show version'))
+        return match.group(1) if match else None
+
+    def bundle(self):
+        """ Returns True if the device started in bundle mode """
+        image = self.boot_image()
+        # install mode boots from a provisioning file
+        if image is None or image.endswith('.conf'):
+            return False
+
+        return is_iosxe_package(image)
+
+class Timer():
+    """ Wall time of the workflow phases and of the CLI calls in each phase """
+    def __init__(self):
+        """ Initializes timer without phase """
+        self.name = None  # name of current phase
+        self.start_time = time.time()
+        self.phases = []  # list of name and seconds of completed phases
+        self.calls = []  # list of phase name, command and seconds
+
+    def start(self, name):
+        """ Completes the current phase and starts the named phase """
+        now = time.time()
+        if self.name is not None:
+            self.phases.append([self.name, round(now - self.start_time, 3)])
+
+        self.name, self.start_time = name, now
+
+    def call(self, func, command, label):
+        """ Returns result of CLI function and records its wall time """
+        start = time.time()
+        try:
+            return func(command)
+        finally:
+            self.calls.append([self.name, label[:60],
+                               round(time.time() - start, 3)])
+
+    def report(self, start, end):
+        """ Returns dict with the phases, including the current phase up to
+        now, and the CLI calls from index start to end, with start as offset """
+        phases = list(self.phases)
+        if self.name is not None:
+            phases.append([self.name, round(time.time() - self.start_time, 3)])
+
+        return dict(phases=phases, calls=self.calls[start:end], offset=start)
+
+class TimedCLI():
+    """ Wraps the functions of the cli module that script.py uses to record
+    the wall time of every call """
+    def __init__(self, module, timer):
+        """ Initializes object with cli module and timer """
+        self.module = module
+        self.timer = timer
+
+    def execute(self, command):
+        """ Executes exec command and returns its output """
+        return self.timer.call(self.module.execute, command, command.strip())
+
+    def configure(self, configuration):
+        """ Applies configuration commands """
+        first = configuration.strip().splitlines()[:1]
+        return self.timer.call(self.module.configure, configuration,
+                               'configure: ' + ''.join(first).strip())
+
+    def cli(self, command):
+        """ Executes commands separated by semicolons and returns output """
+        return self.timer.call(self.module.cli, command, command.strip())
+
+    def __getattr__(self, name):
+        """ x.__getattr__(y) <==> x.y, other attributes of the cli module,
+        for instance for {{...}} expressions in final commands """
+        return getattr(self.module, name)
+
+facts = Facts()  # device facts of this run
+timer = Timer()  # phases and CLI calls of this run
+cli = TimedCLI(cli, timer)  # cli module with timed calls
+
 ##### FUNCTIONS ################################################################
 
 def log(severity, message):
     """ Sends string representation of message to stdout and IOS logging """
-    ztp['logbuf'] += '\n' + str(message)
+    logbuf.append(str(message))
     print('\n%s' % str(message))
     sys.stdout.flush()  # force writing everything in the buffer to the terminal
     if SYSLOG:
         for line in str(message).splitlines():
-            cli.execute('send log %d "%s"' % (severity, line))
-
-def get_serials():
-    """ Returns a dict with switch number as key and serial number as value """
-    inventory = cli.execute('show inventory | format')  # xml formatted output
-    doc = minidom.parseString(inventory)
-    serials = {}
-    for node in doc.getElementsByTagName('InventoryEntry'):
-        chassis = node.getElementsByTagName('ChassisName')[0]
-        # non-stackable
-        if chassis.firstChild.data == '"Chassis"':
-            serials[0] = node.getElementsByTagName('SN')[0].firstChild.data
-
-        # stackable
-        match = re.match('"Switch ([0-9])"', chassis.firstChild.data)
-        if match:
-            unit = int(match.group(1))
-            serials[unit] = node.getElementsByTagName('SN')[0].firstChild.data
-
-    return serials
+            syslog.append('send log %d "%s"' % (severity, line))
+
+def flush_log():
+    """ Sends buffered log lines to IOS logging in as few CLI calls as
+    possible. Commands are separated by semicolons, so lines containing one
+    are sent by themselves """
+    batch = []
+    for command in syslog + [None]:
+        if command is None or ';' in command \
+                or len(' ; '.join(batch + [command])) > BATCH_SIZE:
+            if batch:
+                cli.cli(' ; '.join(batch))
+                batch = []
+            if command is not None and ';' in command:
+                cli.execute(command)
+                continue
+
+        if command is not None:
+            batch.append(command)
+
+    del syslog[:]
 
 def is_iosxe_package(url):
     """ Returns True if the given file is an IOS XE package """
@@ -116,26 +383,28 @@ def is_iosxe_package(url):
 
 def get_version():
     """ Returns a string with the IOS version """
-    version = cli.execute('show version')
-    # extract version string
-    match = re.search('Version ([A-Za-z0-9.:()]+)', version)
-    # remove leading zeros from numbers
-    ver_str = re.sub(r'\b0+(\d)', r'\1', match.group(1)) if match else 'unknown'
-    # extract boot string
-    match = re.search('System image file is "(.*)"', version)
-    # check if the device started in bundle mode
-    ver_str += ' bundle' if match and is_iosxe_package(match.group(1)) else ''
-    return ver_str
+    return facts.version() + (' bundle' if facts.bundle() else '')
 
 def upload(**kwargs):
-    """ Adds given named arguments to dict and sends data to log API """
+    """ Adds given named arguments to dict and sends the changes since the last
+    successful upload to log API. The log buffer is sent from the offset of the
+    lines that were not sent yet, so the GUI app can merge a repeated upload.
+    The CLI calls of the timing are sent the same way """
     ztp.update(kwargs)
     if LOGAPI:
+        sent['seq'] += 1
+        lines, calls = len(logbuf), len(timer.calls)
+        delta = ''.join('\n' + line for line in logbuf[sent['lines']:lines])
+        state = dict(ztp)
+        msg = dict((k, v) for k, v in state.items() if sent['state'].get(k) != v)
+        msg.update(run=RUN, seq=sent['seq'], offset=sent['chars'], logbuf=delta,
+                   timing=timer.report(sent['calls'], calls))
+        filename = os.path.join(GUEST_SHARE_DIR, 'temp.json')
         try:
-            if not os.path.exists('/bootflash/guest-share'):
-                os.mkdir('/bootflash/guest-share')
-            with open('/bootflash/guest-share/temp.json', 'w') as outfile:
-                json.dump(ztp, outfile)
+            if not os.path.exists(GUEST_SHARE_DIR):
+                os.mkdir(GUEST_SHARE_DIR)
+            with open(filename, 'w') as outfile:
+                json.dump(msg, outfile)
         except (OSError, IOError, ValueError) as e:
             log(3, e)
             return
@@ -148,20 +417,24 @@ def upload(**kwargs):
             if match:
                 log(3, match.group(1))
             else:
+                sent.update(lines=lines, chars=sent['chars'] + len(delta),
+                            calls=calls, state=state)
                 break
 
         try:
-            os.remove('/bootflash/guest-share/temp.json')
+            os.remove(filename)
         except OSError as e:
             log(3, e)
 
 def shutdown(save=False, abnormal=False):
     """ Cleansup and saves config if needed and terminates script """
+    timer.start('shutdown')
     if save:
         log(6, 'Saving configuration upon script termination')
 
     # store script state to LOGAPI if specified
     upload(status='Failed' if abnormal else 'Finished')
+    flush_log()
 
     if SYSLOG:
         cli.configure('''no logging host %s
@@ -178,9 +451,9 @@ def renumber_stack(stack, serials):
     if stack is None:
         return False
 
-    # get current switch number and priorities as list of tuples
-    switch = cli.execute('show switch')
-    match = re.findall(r'(\d)\s+\S+\s+\S+\s+(\d+)', switch)
+    # get current switch priorities and active switch number
+    priorities = facts.priorities()
+    active = facts.active()
     # renumber switches
     renumber = False
     for old_num in serials:
@@ -193,6 +466,7 @@ def renumber_stack(stack, serials):
             # renumber switch and log error message in case of failure
             try:
                 cli.execute('switch {} renumber {}'.format(old_num, new_num))
+                facts.invalidate('show switch')
                 log(6, 'Renumbered switch {} to {}'.format(old_num, new_num))
             except Exception as e:  # broad except to support renames in 16.12.x
                 log(3, e)
@@ -201,15 +475,16 @@ def renumber_stack(stack, serials):
         # calculate new switch priority
         new_prio = 16 - int(new_num)
         # lookup current switch priority
-        old_prio = next((prio for num, prio in match if int(num) == old_num), 1)
-        if int(old_prio) != new_prio:
+        old_prio = priorities.get(old_num, 1)
+        if old_prio != new_prio:
             # check if top switch is not active
-            if switch.find('*{}'.format(sorted(serials.keys())[0])) == -1:
+            if active != sorted(serials.keys())[0]:
                 renumber = True
 
             # set switch priority and log error message in case of failure
             try:
                 cli.execute('switch %s priority %d' % (old_num, new_prio))
+                facts.invalidate('show switch')
                 log(6, 'Switch %s priority set to %d' % (old_num, new_prio))
             except Exception as e:  # broad except to support renames in 16.12.x
                 log(3, e)
@@ -225,6 +500,31 @@ def renumber_stack(stack, serials):
 
     return renumber
 
+def staged_image(target, is_chassis):
+    """ Returns URL of the image on flash if its MD5 digest matches the digest
+    published by the server, or None otherwise """
+    if not MD5API or urlparse(target.install).scheme:
+        return None
+
+    fs = 'bootflash:' if is_chassis else 'flash:'
+    local_url = fs + target.install.rstrip('/').split('/')[-1]
+    result = cli.execute('dir %s' % local_url)
+    if re.search('^%Error', result, re.MULTILINE):
+        return None
+
+    digest = download('%s/%s' % (MD5API.rstrip('/'),
+                                 target.install.lstrip('/')), 1).strip()
+    if not re.match('^[0-9a-fA-F]{32}$', digest):
+        return None
+
+    log(6, 'Verifying %s...' % local_url)
+    result = cli.execute('verify /md5 %s %s' % (local_url, digest))
+    if re.search('^Verified', result, re.MULTILINE):
+        return local_url
+
+    log(4, 'MD5 digest of %s does not match' % local_url)
+    return None
+
 def install(target, is_chassis):
     """ Returns True if install script is configured or False otherwise """
     # remove leading zeros from required version numbers and compare
@@ -234,6 +534,17 @@ def install(target, is_chassis):
         return False
 
     install_url = urljoin(target.base_url, target.install)
+    # install from flash if the image has been copied already
+    local_url = staged_image(target, is_chassis)
+    if local_url:
+        log(6, 'Installing %s instead of downloading it' % local_url)
+        install_url = local_url
+        remove = ''  # would remove the inactive image on flash
+    else:
+        remove = r'''action 2.0 syslog msg "Removing inactive images..."
+        action 3.0 cli command "install remove inactive" pattern "\[y\/n\]|#"
+        action 3.1 cli command "y"'''
+
     # terminate script in case of invalid file
     log(6, 'Checking %s' % install_url)
     if not is_iosxe_package(install_url):
@@ -258,22 +569,19 @@ def install(target, is_chassis):
     cli.configure(r'''event manager applet upgrade
         event none maxrun 900
         action 1.0 cli command "enable"
-        action 2.0 syslog msg "Removing inactive images..."
-        action 3.0 cli command "install remove inactive" pattern "\[y\/n\]|#"
-        action 3.1 cli command "y"
+        %s
         action 4.0 syslog msg "Downloading and installing image..."
         action 5.0 cli command "install add file %s activate commit" pattern "\[y\/n\/q\]|#"
         action 5.1 cli command "n" pattern "\[y\/n\]|#"
         action 5.2 cli command "y" %s
         action 6.0 syslog msg "Reloading stack..."
-        action 7.0 reload''' % (install_url, confirm_bm))
+        action 7.0 reload''' % (remove, install_url, confirm_bm))
     return True
 
 def autoupgrade():
     """ Returns True if autoupgrade script is configured or False otherwise """
-    switch = cli.execute('show switch')
     # look for a switch in version mismatch state
-    if switch.find('V-Mismatch') > -1:
+    if facts.v_mismatch():
         # Workaround to execute interactive marked commands from guestshell
         cli.configure('''event manager applet upgrade
             event none maxrun 600
@@ -284,16 +592,60 @@ def autoupgrade():
         return True
     return False
 
+def to_str(data):
+    """ Returns byte string as native string """
+    return data if isinstance(data, str) else data.decode('utf-8', 'replace')
+
 def parse_hex(fmt):
     """ Converts the hex/text format of the IOS more command to string """
-    match = re.findall(r'\S{8}: +(\S{8} +\S{8} +\S{8} +\S{8})', fmt)
-    parts = [base64.b16decode(re.sub(' |X', '', line)) for line in match]
-    return ''.join(parts) if match else fmt
+    match = HEX_LINE.findall(fmt)
+    if not match:
+        return fmt
 
-def download(file_url):
-    """ Returns file contents or empty string in case of failure """
+    # decode all lines at once, X denotes padding beyond the end of file
+    digits = ''.join(match).replace(' ', '').replace('X', '')
+    return to_str(binascii.unhexlify(digits))
+
+def copy_file(file_url):
+    """ Returns file contents copied to guest-share or None on failure """
+    name = 'download.tmp'
+    try:
+        if not os.path.exists(GUEST_SHARE_DIR):
+            os.mkdir(GUEST_SHARE_DIR)
+    except OSError as e:
+        log(3, e)
+        return None
+
+    log(6, 'Copying %s...' % file_url)
+    result = cli.execute('copy %s bootflash:guest-share/%s' % (file_url, name))
+    # log error message in case of failure
+    match = re.search('^(%Error .*)', result, re.MULTILINE)
+    if match:
+        log(3, match.group(1))
+        return None
+
+    try:
+        with open(os.path.join(GUEST_SHARE_DIR, name), 'rb') as infile:
+            return to_str(infile.read())
+    except (OSError, IOError) as e:
+        log(3, e)
+        return None
+    finally:
+        try:
+            os.remove(os.path.join(GUEST_SHARE_DIR, name))
+        except OSError:
+            pass
+
+def download(file_url, attempts=3):
+    """ Returns file contents or empty string in case of failure. Downloads
+    from an API with a local fallback are attempted once """
     if file_url:
-        for retry in range(3):
+        if GUEST_SHARE:
+            result = copy_file(file_url)
+            if result is not None:
+                return result
+
+        for retry in range(attempts):
             log(6, 'Downloading %s...' % file_url)
             result = cli.execute('more %s' % file_url)
             # log error message in case of failure
@@ -304,34 +656,164 @@ def download(file_url):
                 break
 
         # extract file contents from output
-        match = re.search('^Loading %s (.*)' % file_url, result, re.DOTALL)
+        match = re.search('^Loading %s (.*)' % re.escape(file_url), result,
+                          re.DOTALL)
         return parse_hex(match.group(1)) if match else ''
     return ''
 
-def apply_config(target):
-    """ Returns True if configuration template is applied successfully """
-    cfg_url = urljoin(target.base_url, target.config) if target.config else None
+def split_config(conf):
+    """ Returns list of top-level stanzas of configuration text, each a list of
+    lines starting with the top-level command. Indentation is relative to the
+    least indented line after the first, like a docstring, so a template in a
+    triple-quoted string splits like a file. Comments, empty lines and 'end'
+    are left out, banner text is kept up to its delimiter """
+    commands = [line.expandtabs() for line in conf.splitlines()
+                if line.strip() and not line.lstrip().startswith('!')]
+    indents = [len(line) - len(line.lstrip()) for line in commands[1:]]
+    base = min(indents) if indents else 0
+    stanzas = []
+    lines = iter(conf.splitlines())
+    for line in lines:
+        line = line.expandtabs().rstrip()
+        if not line.strip() or line.lstrip().startswith('!') \
+                or line.strip() == 'end':
+            continue
 
-    # remove keyword 'end' from downloaded configuration
-    conf = re.sub(r'^\s*end\s*$', '', download(cfg_url), flags=re.MULTILINE)
-    if target.template:
-        conf += '\n' + target.template if conf else target.template
+        if len(line) - len(line.lstrip()) > base and stanzas:
+            stanzas[-1].append(line)
+            continue
 
-    if len(conf) == 0:
-        return False
+        stanzas.append([line])
+        match = re.match(r'^banner\s+\S+\s+(\^C|\S)(.*)$', line)
+        if match and match.group(1) not in match.group(2):
+            for text in lines:
+                stanzas[-1].append(text)
+                if match.group(1) in text:
+                    break
 
-    # build configuration from template by $-based substitutions
-    if target.subst:
-        conf = Template(conf).safe_substitute(target.subst)
+    return stanzas
 
-    # apply configuration and log error message in case of failure
+def running_config():
+    """ Returns dict with set of sub-commands by top-level command of the
+    running configuration, or empty dict if it cannot be read """
     try:
-        cli.configure(conf)
+        result = cli.execute('show running-config')
     except Exception as e:  # broad except to support class renames in 16.12.x
-        log(3, e)
-        shutdown(save=False, abnormal=True)  # terminate script
+        log(4, e)
+        return {}
+
+    running = {}
+    for stanza in split_config(result):
+        running.setdefault(stanza[0].strip(), set()).update(
+            line.strip() for line in stanza[1:])
+
+    return running
+
+def is_parent(command, running):
+    """ Returns True if top-level command enters a sub-mode """
+    command = command.strip()
+    return bool(PARENT.match(command) or running.get(command))
+
+def is_ambiguous(stanzas, running):
+    """ Returns True if the indentation of the stanzas does not show the
+    structure of the configuration: a sub-mode command without sub-commands
+    that is followed by a command which may be its sub-command, as in a flat
+    template, or sub-commands below a command that has no sub-mode """
+    for index, stanza in enumerate(stanzas):
+        parent = is_parent(stanza[0], running)
+        if stanza[0].strip().startswith('banner'):
+            continue
+        if len(stanza) > 1 and not parent:
+            return True
+        if len(stanza) == 1 and parent and index + 1 < len(stanzas) \
+                and not is_parent(stanzas[index + 1][0], running):
+            return True
+
+    return False
+
+def is_configured(stanza, running):
+    """ Returns True if top-level command and all sub-commands of stanza are
+    in the running configuration. Banners and sub-mode commands without
+    sub-commands are always applied """
+    commands = running.get(stanza[0].strip())
+    if commands is None or stanza[0].strip().startswith('banner'):
+        return False
+    if len(stanza) == 1:
+        return not is_parent(stanza[0], running)
+
+    return all(line.strip() in commands for line in stanza[1:])
+
+def configure(conf):
+    """ Returns True if all stanzas of configuration that are missing from the
+    running configuration are applied, in batches of at most CONFIG_BATCH
+    lines. A failed batch is logged and the next batch is applied. The whole
+    configuration is applied at once if its structure is ambiguous """
+    stanzas = split_config(conf)
+    running = running_config()
+    batches = []
+    if is_ambiguous(stanzas, running):
+        # batches start in global configuration mode, so apply all in one
+        log(6, 'Applying all configuration at once, its structure is unclear')
+        if stanzas:
+            batches.append(stanzas)
     else:
-        return True
+        missing = [stanza for stanza in stanzas
+                   if not is_configured(stanza, running)]
+        log(6, 'Applying %d of %d configuration stanzas'
+            % (len(missing), len(stanzas)))
+        for stanza in missing:
+            if batches and sum(map(len, batches[-1])) + len(stanza) \
+                    <= CONFIG_BATCH:
+                batches[-1].append(stanza)
+            else:
+                batches.append([stanza])
+
+    success = True
+    for number, batch in enumerate(batches, 1):
+        lines = [line for stanza in batch for line in stanza]
+        start = time.time()
+        try:
+            cli.configure('\n'.join(lines))
+        except Exception as e:  # broad except to support renames in 16.12.x
+            log(3, 'Configuration batch %d of %d (%s ... %s) failed: %s'
+                % (number, len(batches), batch[0][0], batch[-1][0], e))
+            success = False
+        else:
+            log(6, 'Configuration batch %d of %d, %d lines in %.1f seconds'
+                % (number, len(batches), len(lines), time.time() - start))
+
+    return success
+
+def apply_config(target):
+    """ Returns True if configuration template is applied successfully """
+    # download configuration rendered by the server, which can only render
+    # configuration files that are a local path on the server
+    conf = ''
+    if CONFIGAPI and (target.config or target.template) \
+            and not urlparse(target.config or '').scheme:
+        conf = download('%s/%s' % (CONFIGAPI.rstrip('/'), ztp['serial']), 1)
+
+    if len(conf) == 0:
+        cfg_url = urljoin(target.base_url, target.config) if target.config \
+            else None
+        # remove keyword 'end' from downloaded configuration
+        conf = re.sub(r'^\s*end\s*$', '', download(cfg_url),
+                      flags=re.MULTILINE)
+        if target.template:
+            conf += '\n' + target.template if conf else target.template
+
+        if len(conf) == 0:
+            return False
+
+        # build configuration from template by $-based substitutions
+        if target.subst:
+            conf = Template(conf).safe_substitute(target.subst)
+
+    # apply missing configuration and terminate script in case of failure
+    if not configure(conf):
+        shutdown(save=False, abnormal=True)
+
+    return True
 
 def blue_beacon(sw_nums):
     """ Turns on blue beacon of given switch number list, if supported """
@@ -385,78 +867,104 @@ def final_cli(command):
 
 def main():
     """ Executes main workflow """
-    # setup IOS syslog for our own messages if server IP is specified
-    if SYSLOG:
-        cli.configure('''logging discriminator ztp msg-body includes Message from|HA_EM|INSTALL
-            logging host %s discriminator ztp''' % SYSLOG)
-        time.sleep(2)
-
-    # show script name
-    log(6, '*** Running %s ***' % os.path.basename(sys.argv[0]))
-    # get platform serial numers and software version
-    serials = get_serials()
-    log(6, 'Platform serial number(s): %s' % ', '.join(serials.values()))
-    ztp['version'] = get_version()
-    log(6, 'Platform software version: %s' % ztp['version'])
-    # load JSON formatted data if URL is specified and concatenate it to DATA
-    json_str = download(JSON)
     try:
-        data = DATA + json.loads(json_str) if json_str else DATA
-    except ValueError as e:
-        log(3, e)
-        shutdown(save=False, abnormal=True)  # malformed data; terminate script
-
-    # lookup stack in dataset, if not found turn on beacon
-    target = Stack(data, serials)
-    if target.stack is None:
-        log(4, '% Stack not found in dataset')
-        blue_beacon(serials.keys())
-        ztp['serial'] = serials[sorted(serials.keys())[0]]
-    else:
-        ztp['serial'] = target.stack[sorted(target.stack.keys())[0]]
-        # check if all specified switches are found, turn on beacon if not
-        missing = set(target.stack.values()) - set(serials.values())
-        if missing:
-            log(4, 'Missing switch(es): %s' % ', '.join(missing))
-            blue_beacon(serials.keys())
+        # setup IOS syslog for our own messages if server IP is specified
+        timer.start('syslog')
+        if SYSLOG:
+            cli.configure('''logging discriminator ztp msg-body includes Message from|HA_EM|INSTALL
+                logging host %s discriminator ztp''' % SYSLOG)
+            time.sleep(2)
+
+        # show script name
+        log(6, '*** Running %s ***' % os.path.basename(sys.argv[0]))
+        # get platform serial numers and software version
+        timer.start('get_serials')
+        serials = facts.serials()
+        log(6, 'Platform serial number(s): %s' % ', '.join(serials.values()))
+        ztp['platform'] = facts.platform()
+        timer.start('get_version')
+        ztp['version'] = get_version()
+        log(6, 'Platform software version: %s' % ztp['version'])
+        # load JSON formatted data if URL is specified and concatenate to DATA
+        timer.start('data')
+        if JSON and LOOKUP:
+            # only download the defaults and the stack with our serial numbers
+            sn_list = ','.join(serials.values())
+            json_str = download('%s/%s' % (JSON.rstrip('/'), sn_list))
+        else:
+            json_str = download(JSON)
+        try:
+            index = DataIndex(DATA, json_str)
+        except ValueError as e:
+            log(3, e)
+            # malformed data; terminate script
+            shutdown(save=False, abnormal=True)
 
-        # check if all found switches are specified, turn on beacon if not
-        extra = set(serials.values()) - set(target.stack.values())
-        if extra:
-            log(4, 'Extra switch(es): %s' % ', '.join(extra))
+        # lookup stack in dataset, if not found turn on beacon
+        target = Stack(index, serials)
+        if target.stack is None:
+            log(4, '% Stack not found in dataset')
             blue_beacon(serials.keys())
-
-    is_chassis = bool(0 in serials)
-    # first, check version and install software if needed
-    if install(target, is_chassis):
-        log(6, 'Software upgrade starting asynchronously...')
-        upload(status='Upgrading')
-        cli.execute('event manager run upgrade')
-    else:
-        # second, check v-mismatch and perform autoupgrade if needed
-        if not is_chassis and autoupgrade():
-            log(6, 'V-Mismatch detected, upgrade starting asynchronously...')
+            ztp['serial'] = serials[sorted(serials.keys())[0]]
+        else:
+            ztp['serial'] = target.stack[sorted(target.stack.keys())[0]]
+            # check if all specified switches are found, turn on beacon if not
+            missing = set(target.stack.values()) - set(serials.values())
+            if missing:
+                log(4, 'Missing switch(es): %s' % ', '.join(missing))
+                blue_beacon(serials.keys())
+
+            # check if all found switches are specified, turn on beacon if not
+            extra = set(serials.values()) - set(target.stack.values())
+            if extra:
+                log(4, 'Extra switch(es): %s' % ', '.join(extra))
+                blue_beacon(serials.keys())
+
+        flush_log()
+        is_chassis = bool(0 in serials)
+        # first, check version and install software if needed
+        timer.start('install')
+        if install(target, is_chassis):
+            log(6, 'Software upgrade starting asynchronously...')
             upload(status='Upgrading')
+            flush_log()
             cli.execute('event manager run upgrade')
         else:
-            log(6, 'No software upgrade required')
-            # third, check switch numbering and renumber stack if needed
-            if not is_chassis and renumber_stack(target.stack, serials):
-                log(6, 'Stack renumbered, reloading stack...')
-                upload(status='Renumbered')
-                cli.execute('reload')
+            # second, check v-mismatch and perform autoupgrade if needed
+            timer.start('autoupgrade')
+            if not is_chassis and autoupgrade():
+                log(6, 'V-Mismatch detected, upgrade starting '
+                    'asynchronously...')
+                upload(status='Upgrading')
+                flush_log()
+                cli.execute('event manager run upgrade')
             else:
-                log(6, 'No need to renumber stack')
-                # fourth, apply configuration template if specified
-                if apply_config(target):
-                    log(6, 'Configuration template applied successfully')
-                # fifth, execute final cli if specified
-                if final_cli(target.cli):
-                    log(6, 'Final command(s) executed successfully')
-
-                # cleanup after step 4 or 5 and save config if specified
-                log(6, 'End of workflow reached')
-                shutdown(save=target.save, abnormal=False)
+                log(6, 'No software upgrade required')
+                # third, check switch numbering and renumber stack if needed
+                timer.start('renumber_stack')
+                if not is_chassis and renumber_stack(target.stack, serials):
+                    log(6, 'Stack renumbered, reloading stack...')
+                    upload(status='Renumbered')
+                    flush_log()
+                    cli.execute('reload')
+                else:
+                    log(6, 'No need to renumber stack')
+                    # fourth, apply configuration template if specified
+                    timer.start('apply_config')
+                    if apply_config(target):
+                        log(6, 'Configuration template applied successfully')
+                    flush_log()
+                    # fifth, execute final cli if specified
+                    timer.start('final_cli')
+                    if final_cli(target.cli):
+                        log(6, 'Final command(s) executed successfully')
+
+                    # cleanup after step 4 or 5 and save config if specified
+                    log(6, 'End of workflow reached')
+                    shutdown(save=target.save, abnormal=False)
+    finally:
+        # send buffered log lines also when a CLI call raised an exception
+        flush_log()
 
 if __name__ == "__main__":
     main()